@@ -1,13 +1,15 @@
 import streamlit as st
 import pandas as pd
 import os
-import plotly.express as px
-import matplotlib.pyplot as plt
-from matplotlib_venn import venn2
-from utils.data_chunks import scrape_chunks
-from utils.xing_scraper import scraper
-from utils.data_cleaning import clean_data, preprocess_company_list, preprocess_scraped_data
-from utils.ml_functions import kmeans_clustering, plot_clusters_2d, violin_plots
+import hashlib
+import time
+from utils.data_chunks import export_scraped_data, CACHE_PATH
+from utils.result_store import ScrapeStore
+from utils.scrape_jobs import ACTIVE, job_queue, source_for
+from utils.pipeline import CUSTOMERS_PATH
+from utils.matching import SORT_KEYS
+from utils import app_cache, dataset_catalog
+from utils.telemetry import telemetry
 
 st.set_page_config(
     page_title="find(IQ) potential customers",
@@ -15,8 +17,10 @@ st.set_page_config(
     layout="wide"
 )
 
+telemetry.start_run()
+run_start = time.perf_counter()
+
 st.title("find(IQ) potential customers")
-st.session_state["file_saved"] = False
 st.session_state["continue"] = False
 # Tabs
 tab1, tab2, tab3, tab4 = st.tabs(["Update company data", "View company data", "Clustering", "Visualisation"])
@@ -25,13 +29,18 @@ with tab1:
     # Current customers
     st.subheader("findIQ customers")
     st.write("Data for the current customers is saved in an Excel file. You can update this data by uploading a new file.")
-    current_customers = pd.read_excel('data/customers/Active_Accounts_with_revenue.xlsx')
+    current_customers = app_cache.load_dataset(CUSTOMERS_PATH, "customers")
+    customers_key = app_cache.file_hash(CUSTOMERS_PATH)
     if st.button("Update current customers"):
         uploaded_customers = st.file_uploader("Choose an Excel file with current customers", type=["xlsx"])
         if uploaded_customers is not None:
             current_customers = pd.read_excel(uploaded_customers, header=1)
+            customers_key = hashlib.sha1(uploaded_customers.getvalue()).hexdigest()
             timestamp = pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")
-            current_customers.to_excel(f'data/customers/Active_Accounts_with_revenue_{timestamp}.xlsx', index=False)
+            customers_path = f'data/customers/Active_Accounts_with_revenue_{timestamp}.xlsx'
+            current_customers.to_excel(customers_path, index=False)
+            dataset_catalog.ingest(customers_path, "customers", current_customers)
+            app_cache.clear()
             st.success("Customer data updated.")
         else:
             st.write("Please upload an Excel file to proceed.")
@@ -42,71 +51,158 @@ with tab1:
     use_existing_file = st.selectbox(
         "Please choose an option",
         options=["Use existing list of companies", "Upload new list of companies"])
+    artifacts = None
     if use_existing_file == "Upload new list of companies":
         st.write("In this case you need to scrape data from Xing, which might take a while.")
         file = st.file_uploader("Choose an Excel file", type=["xlsx"])
         if file is None:
             st.write("Please upload an Excel file to proceed.")
         else:
-            df_company_data = pd.read_excel(file, header=1)
-            timestamp = pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"company_data_{timestamp}.xlsx"
+            company_key = hashlib.sha1(file.getvalue()).hexdigest()
+            # Save every uploaded file only once, not on every rerun
+            if st.session_state.get("saved_upload") != company_key:
+                try:
+                    df_company_data = dataset_catalog.read_company_list(file)
+                except ValueError as e:
+                    st.error(f"The uploaded file cannot be used. {e}")
+                    st.stop()
+                timestamp = pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")
+                filename = f"company_data_{timestamp}.xlsx"
+                # The uploaded file is saved as it is instead of writing the parsed data to Excel again
+                with open(f'data/company_data/{filename}', "wb") as f:
+                    f.write(file.getvalue())
+                dataset_catalog.ingest(f'data/company_data/{filename}', "company_data", df_company_data)
+                app_cache.clear()
+                st.session_state["saved_upload"] = company_key
+                st.session_state["saved_upload_filename"] = filename
+            filename = st.session_state["saved_upload_filename"]
             file_path = f'data/company_data/{filename}'
-            if st.session_state["file_saved"] == False:
-                df_company_data.to_excel(file_path, index=False)
-                st.session_state["file_saved"] = True
+            df_company_data = app_cache.load_dataset(file_path, "company_data")
             st.success(f"File uploaded and saved to {file_path}")
     elif use_existing_file == "Use existing list of companies":
         st.write("Choose the excel file you want to use.")
-        filenames = os.listdir("data/company_data/")
-        xlsx_files = [f for f in filenames if f.endswith('.xlsx')]
-        filename = st.selectbox("Select a file", xlsx_files)
-        df_company_data = pd.read_excel(f'data/company_data/{filename}', header=1)
-        if not "Last Modified Date" in df_company_data.columns:
-            df_company_data = pd.read_excel(f'data/company_data/{filename}')
-    if f"xing_data_{filename}" in os.listdir("data/scraped_data/"):
+        datasets = {dataset["name"]: dataset for dataset in dataset_catalog.list_datasets("company_data")}
+        filename = st.selectbox("Select a file", list(datasets),
+                                format_func=lambda name: f"{name} (cannot be used)" if "error" in datasets[name]
+                                else f"{name} ({datasets[name]['rows']} companies)")
+        if "error" in datasets.get(filename, {}):
+            st.error(f"{filename} cannot be used. {datasets[filename]['error']}")
+            st.stop()
+        # Results of the batch pipeline (python -m utils.pipeline) are used if they are up to date
+        company_key = app_cache.file_hash(f'data/company_data/{filename}')
+        artifacts = app_cache.load_artifacts(f'data/company_data/{filename}')
+        if artifacts is None:
+            df_company_data = app_cache.load_dataset(f'data/company_data/{filename}', "company_data")
+        else:
+            st.info(f"Using results of the batch pipeline from {artifacts['finished_at'][:16]}.")
+    path_scraped = f'data/scraped_data/xing_data_{filename}'
+
+    if artifacts is None:
+        df_company_data = app_cache.preprocess_company_list((company_key, customers_key), df_company_data, current_customers)
+    else:
+        df_company_data = artifacts["companies_matched"]
+    companies = df_company_data["Company"].tolist()
+    # Scraped data written by a scrape that did not finish covers only part of the list
+    last_job = job_queue.last_job(companies, path_scraped)
+    if os.path.exists(path_scraped) and last_job is not None and last_job["status"] not in ("done", *ACTIVE):
+        st.warning(
+            f"Scraped data for {filename} is incomplete, it covers {last_job['done']} of {last_job['total']} companies. "
+            + "\n\nPlease click the button below to scrape the remaining companies.")
+    elif os.path.exists(path_scraped):
         st.success(
             f"Scraped data for {filename} is available. \n\nIf you want to update the scraped data, please click the button below. "
             + "Updating might take a while.")
     else:
         st.warning(f"No scraped data for {filename} available")
 
-    path_scraped = f'data/scraped_data/xing_data_{filename}'
-
-    df_company_data = preprocess_company_list(df_company_data, current_customers)
-
     # Scraping
     st.subheader("Scrape service technician ads from Xing")
-    if st.button("Scrape data from Xing", help=f"Estimated time to scrape: {len(df_company_data)/100*3.2:.0f} minutes."):
-        st.write("Company data will be scraped and saved.")
-        scrape_chunks(df_company_data, scraper, path_scraped, 100)
-        st.success(f"Company data scraped and saved to {path_scraped}")
-    try:
-        df_xing_orig = pd.read_excel(path_scraped)
-        df_xing = preprocess_scraped_data(df_xing_orig, current_customers)
+    # The batched modes of scrape_jobs.MODES are left out until their coverage on Xing has been checked
+    # with python -m utils.batched_search
+    scraping_mode = st.selectbox(
+        "Scraping mode",
+        options=["Browser", "HTTP"],
+        help="HTTP requests the search result pages directly without starting Chrome and is much faster.")
+    source = source_for(scraping_mode)
+    n_workers = st.number_input("Number of parallel browsers", min_value=1, max_value=8, value=1,
+                                help="Each browser scrapes its own chunks of companies.")
+    ttl_days = st.number_input("Scrape again if results are older than (days)", min_value=0, value=7,
+                               help="Companies scraped more recently are taken from the cache.")
+    ttl = pd.Timedelta(days=ttl_days)
+    n_missing = len(ScrapeStore(CACHE_PATH, source).missing(companies, ttl))
+    # A scrape of this list may have been started by another user or before the page was refreshed
+    job = job_queue.active_job(companies, path_scraped, scraping_mode)
+    if job is not None:
+        st.session_state["scrape_job"] = job["id"]
+    elif st.button("Scrape data from Xing",
+                   help=f"{n_missing} of {len(df_company_data)} companies need to be scraped. "
+                        + f"Estimated time to scrape: {n_missing/100*3.2/n_workers:.0f} minutes."):
+        st.session_state["scrape_job"] = job_queue.submit(companies, path_scraped, scraping_mode, n_workers, ttl)
+
+    @st.fragment(run_every=2)
+    def scrape_progress(job_id: int):
+        job = job_queue.status(job_id)
+        if job is None:
+            # The job table was deleted or replaced since the job was submitted
+            del st.session_state["scrape_job"]
+            st.warning("The scrape job no longer exists. Scrape again to continue with the remaining companies.")
+            return
+        if job["status"] in ACTIVE:
+            text = f"{job['done']} of {job['total']} companies scraped"
+            if job["eta"] is not None:
+                text += f", about {job['eta'] / 60:.0f} minutes left"
+            if job["status"] == "queued":
+                text = "Waiting for other scrapes to finish"
+            st.progress(job["done"] / max(1, job["total"]), text=text)
+            partial = job_queue.partial_results(job_id)
+            if len(partial):
+                st.write("Companies with the most ads found so far:")
+                st.dataframe(partial.sort_values("count", ascending=False).head(10), hide_index=True)
+            return
+        del st.session_state["scrape_job"]
+        st.session_state["scrape_result"] = job
+        # Reload the app with the new scraped data
+        st.rerun()
+
+    if "scrape_job" in st.session_state:
+        st.write("Company data is being scraped in the background. You can leave this page, the scrape continues.")
+        scrape_progress(st.session_state["scrape_job"])
+    if "scrape_result" in st.session_state:
+        job = st.session_state.pop("scrape_result")
+        if job["status"] == "done":
+            st.success(f"Company data scraped and saved to {job['path']}")
+        else:
+            st.warning(f"Scraping {job['status']}: {job['error'] or 'the app was restarted'}. "
+                       + "Scrape again to continue with the remaining companies.")
+    # A job may have been submitted or finished above
+    last_job = job_queue.last_job(companies, path_scraped)
+    # Only lists scraped in the app are exported from the cache, not every list sharing some cached companies
+    if not os.path.exists(path_scraped) and last_job is not None \
+            and export_scraped_data(path_scraped, companies, source_for(last_job["mode"])):
+        if last_job["status"] in ACTIVE:
+            st.info("Results are shown for the companies scraped so far.")
+        elif last_job["status"] != "done":
+            st.info("The last scrape did not finish. Scraped data collected so far has been saved.")
+    scraped_key = app_cache.file_hash(path_scraped)
+    if artifacts is not None:
+        df_xing = artifacts["scraped"]
+        company_data_selection = artifacts["leads"]
+        df_rest = artifacts["additional_companies"]
         st.session_state["continue"] = True
-    except FileNotFoundError:
-        st.warning("No scraped data available yet. Please scrape data from Xing.")
-    # Find intersection between company data and Xing data
+    else:
+        try:
+            df_xing_orig, df_xing = app_cache.preprocess_scraped_data(
+                (scraped_key, customers_key), app_cache.load_dataset(path_scraped, "scraped_data"), current_customers)
+            st.session_state["continue"] = True
+        except FileNotFoundError:
+            st.warning("No scraped data available yet. Please scrape data from Xing.")
+        # Find intersection between company data and Xing data
+        if st.session_state["continue"]:
+            df_company_data, company_data_selection, df_rest = app_cache.build_lead_table(
+                (company_key, customers_key, scraped_key), df_company_data, df_xing_orig, df_xing, current_customers)
     if st.session_state["continue"]:
-        intersection = list(set(df_company_data["lowercase_company"].tolist()).intersection(set(df_xing["lowercase_company"].unique().tolist())))
-        df_company_data["Service technician ads"] = 0
-        for c in intersection:
-            df_company_data.loc[df_company_data["lowercase_company"] == c, "Service technician ads"] = df_xing.loc[df_xing["lowercase_company"] == c, "count"].values[0]
-        company_data_selection_orig = df_company_data[df_company_data["Service technician ads"] > 0]
-        # Remove companies that are already our customers:
-        intersection_current_customers = list(set(company_data_selection_orig["Company"].tolist()).intersection(set(current_customers["Company"].unique().tolist())))
-        if len(intersection_current_customers) > 0:
-            for c in intersection_current_customers:
-                company_data_selection = company_data_selection_orig.drop(company_data_selection_orig[company_data_selection_orig["Company"] == c].index)
-        else:
-            company_data_selection = company_data_selection_orig.copy()
-        # Compute number of job ads per 100 employees:
-        df_company_data["Ads per 100 employees"] = df_company_data["Service technician ads"] / df_company_data["Employees"] * 100
-        company_data_selection["Ads per 100 employees"] = company_data_selection["Service technician ads"] / company_data_selection["Employees"] * 100
-        company_data_selection = company_data_selection.sort_values(by="Ads per 100 employees", ascending=False).reset_index(drop=True)
+        n_companies_with_ads = int((df_company_data["Service technician ads"] > 0).sum())
         st.write(f"Number of companies with service technician ads: {len(company_data_selection)} \n\n You can view details on these companies in the 'View company data' tab.")
-        df_rest = df_xing_orig[~df_xing_orig["lowercase_company"].isin(intersection)]
 
 with tab2:
     if st.session_state["continue"]:
@@ -117,11 +213,10 @@ with tab2:
 - the number of companies found on Xing with service technician ads (green)
 - the intersection of both (brown)""")
         with cols[1]:
-            venn_fig = plt.figure(figsize=(4,4))
-            venn = venn2(
-                subsets=(len(df_company_data), len(df_xing), len(company_data_selection_orig)),
+            venn_png = app_cache.venn_diagram(
+                subsets=(len(df_company_data), len(df_xing), n_companies_with_ads),
                 set_labels=('Excel list of companies', 'Xing search'))
-            st.pyplot(venn_fig)
+            st.image(venn_png)
         with cols[2]:
             st.write("The table below shows companies in the intersection, where our current customers are already excluded.")
         st.subheader("Selection from list of companies  (🔜 📞)")
@@ -143,16 +238,28 @@ with tab3:
         with cols[0]:
             n_clusters = st.selectbox("Select number of clusters", options=[2, 3, 4, 5, 6], index=3)
         X = df_company_data[["Annual Revenue (USD)", "Employees"]]
-        df_clustered, kmeans, scaler = kmeans_clustering(X, n_clusters=n_clusters)
+        if artifacts is not None:
+            df_clustered, kmeans, scaler = artifacts[f"clusters_{n_clusters}"]
+            cluster_scores = artifacts["cluster_scores"]
+        else:
+            # All numbers of clusters are fitted at once in parallel, so changing the selection is instant
+            clusterings = app_cache.clusterings((company_key, customers_key), X)
+            df_clustered, kmeans, scaler = clusterings[n_clusters]
+            cluster_scores = app_cache.cluster_scores((company_key, customers_key), clusterings)
         df_company_data["Cluster labels"] = df_clustered["Cluster labels"]
         if st.button("Show silhouette score"):
-            from sklearn.metrics import silhouette_score
-            silhouette_avg = silhouette_score(X, df_clustered["Cluster labels"])
-            st.metric("Silhouette Score", f"{silhouette_avg:.2f}")
+            scores = cluster_scores.set_index("Number of clusters").loc[n_clusters]
+            st.metric("Silhouette Score", f"{scores['Silhouette score']:.2f}")
+            if scores["Silhouette 95% CI low"] < scores["Silhouette 95% CI high"]:
+                st.write(f"Computed on a sample of the companies, 95% confidence interval: "
+                         f"{scores['Silhouette 95% CI low']:.2f} to {scores['Silhouette 95% CI high']:.2f}.")
             st.write(f"A higher silhouette score indicates better-defined clusters, where the "
                     " maximum value is 1 and worst value is -1.")
+            st.write("Scores for all numbers of clusters (a higher Calinski-Harabasz and a lower Davies-Bouldin "
+                     "score also indicate better-defined clusters):")
+            st.dataframe(cluster_scores, hide_index=True)
         # Plot companies with clusters and show current customers as dark crosses
-        fig = plot_clusters_2d(df_clustered, kmeans, scaler, current_customers)
+        fig = app_cache.plot_clusters_2d((company_key, customers_key, n_clusters), df_clustered, kmeans, scaler, current_customers)
         st.plotly_chart(fig, use_container_width=True)
 
         # Prediction of clusters for current customers
@@ -161,20 +268,27 @@ with tab3:
         cluster_counts = current_customers["Cluster"].value_counts().reset_index()
         index = current_customers["Cluster"].value_counts().argmax()
         st.write(f"Most of our customers are in cluster {cluster_counts.loc[index, 'Cluster']}, which contains {cluster_counts.loc[index, 'count']} of our current customers.")
-        fig = violin_plots(df_clustered)
+        fig = app_cache.violin_plots((company_key, customers_key, n_clusters), df_clustered)
         st.plotly_chart(fig, use_container_width=True)
         st.write("The violin plots above show that most of our customers have a relatively low annual revenue and small number of employees.")
         # Top ten companies in chosen cluster:
-        st.write("Please choose a cluster number to display the top ten companies out of this cluster with the highest number of job advertisements.")
-        cluster_number = st.selectbox("Select cluster number", options=list(range(n_clusters)))
-        top_companies = df_company_data[df_company_data["Cluster labels"] == cluster_number].sort_values(by="Ads per 100 employees", ascending=False)
-        # Remove companies that are already our customers:
-        intersection_current_customers = list(set(top_companies["Company"].tolist()).intersection(set(current_customers["Company"].unique().tolist())))
-        if len(intersection_current_customers) > 0:
-            for c in intersection_current_customers:
-                top_companies = top_companies.drop(top_companies[top_companies["Company"] == c].index)
-        st.write(f"Top 10 companies in cluster {cluster_number}:")
-        st.dataframe(top_companies[["Company", "Annual Revenue (USD)", "Employees", "Industry", "Service technician ads", "Ads per 100 employees"]].head(10))
+        st.write("Please choose a cluster number to display the top companies out of this cluster with the highest number of job advertisements per 100 employees.")
+        cols = st.columns(4)
+        with cols[0]:
+            cluster_number = st.selectbox("Select cluster number", options=list(range(n_clusters)))
+        with cols[1]:
+            top_k = st.number_input("Number of companies", min_value=1, max_value=100, value=10)
+        with cols[2]:
+            tie_breaker = st.selectbox("For equal ads per 100 employees, sort by", options=SORT_KEYS[1:])
+        sort_by = [SORT_KEYS[0], tie_breaker]
+        # Companies that are already our customers are excluded by the index
+        if artifacts is not None and artifacts[f"top_k_index_{n_clusters}"].covers(top_k, sort_by):
+            index = artifacts[f"top_k_index_{n_clusters}"]
+        else:
+            index = app_cache.top_k_index((company_key, customers_key, scraped_key, n_clusters), df_company_data, top_k, tuple(sort_by))
+        top_companies = index.lookup(cluster_number, top_k)
+        st.write(f"Top {top_k} companies in cluster {cluster_number}:")
+        st.dataframe(top_companies[["Company", "Annual Revenue (USD)", "Employees", "Industry", "Service technician ads", "Ads per 100 employees"]])
     else:
         st.warning("Some data is still missing.")
 
@@ -182,20 +296,22 @@ with tab4:
     st.subheader("Visualisation of additional information")
     if st.session_state["continue"]:
         st.write("Visualisation of the data for our customers and companies which have job advertisements for service technicians or similar positions.")
-        df_joined = pd.concat([
-            company_data_selection[["Company", "Annual Revenue (USD)", "Employees", "Industry"]],
-            current_customers[["Company", "Annual Revenue (USD)", "Employees", "Industry"]]
-            ], ignore_index=True)
-        df_joined["Current customer"] = ["No"] * len(company_data_selection) + ["Yes"] * len(current_customers)
-
-        fig = px.histogram(df_joined, x="Industry", color="Current customer", title="Industry Distribution").update_xaxes(categoryorder="total descending")
+        fig = app_cache.industry_histogram((company_key, customers_key, scraped_key), company_data_selection, current_customers)
         st.plotly_chart(fig, use_container_width=True)
         st.write("The information on the industry is not included in the clustering as there are too many different industries compared to the number "
                 + " of companies. However, it is still interesting to see the distribution of industries among our current customers and the potential customers.")
-        fig = px.bar(x=company_data_selection.sort_values(by="Service technician ads", ascending=False)["Company"].head(10),
-                     y=company_data_selection.sort_values(by="Service technician ads", ascending=False)["Service technician ads"].head(10),
-                     title="Top 10 companies with most service technician ads")
-        fig.update_layout(xaxis_title="Company", yaxis_title="Number of service technician ads")
+        fig = app_cache.top_ads_bar((company_key, customers_key, scraped_key), company_data_selection)
         st.plotly_chart(fig, use_container_width=True)
     else:
-        st.warning("Some data is still missing.")
\ No newline at end of file
+        st.warning("Some data is still missing.")
+
+# Time spent in the stages of this run. Results served from the cache don't show up.
+with st.sidebar:
+    st.subheader("Timing of this run")
+    st.write(f"Total: {time.perf_counter() - run_start:.2f} s")
+    st.dataframe(telemetry.breakdown(), hide_index=True)
+    query_summary = telemetry.query_summary()
+    if not query_summary.empty:
+        st.write("Scraper queries:")
+        st.dataframe(query_summary, hide_index=True)
+telemetry.flush()
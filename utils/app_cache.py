@@ -0,0 +1,153 @@
+"""
+Caching of loading, preprocessing, matching and clustering across reruns of the Streamlit app.
+
+Every widget interaction reruns app.py. The functions below are cached with st.cache_data and keyed by
+the content hash of the input files and the relevant parameters, so a rerun only recomputes what depends
+on a changed input. Each cache keeps at most MAX_ENTRIES results to bound the memory usage.
+Figures are cached with st.cache_resource, as they are only read and unpickling them is slow.
+"""
+import hashlib
+import os
+from io import BytesIO
+import matplotlib.pyplot as plt
+import pandas as pd
+from matplotlib_venn import venn2
+import streamlit as st
+from utils import data_cleaning, dataset_catalog, matching, ml_functions, pipeline
+
+MAX_ENTRIES = 8
+_file_hashes = {}
+
+
+def file_hash(path: str) -> str:
+    """
+    Returns the SHA-1 hash of the content of a file, or "" if it does not exist.
+    The hash is only recomputed if the modification time or size of the file has changed.
+    """
+    if not os.path.exists(path):
+        return ""
+    stat = os.stat(path)
+    signature = (path, stat.st_mtime_ns, stat.st_size)
+    if signature not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        _file_hashes[signature] = sha1.hexdigest()
+    return _file_hashes[signature]
+
+
+def clear():
+    """Drops all cached results, e.g. after a new file has been uploaded."""
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    _file_hashes.clear()
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def _load_dataset(path: str, kind: str, content_hash: str) -> pd.DataFrame:
+    return dataset_catalog.load(path, kind)
+
+
+def load_dataset(path: str, kind: str) -> pd.DataFrame:
+    """Loads an Excel file from its columnar sidecar (see dataset_catalog)."""
+    return _load_dataset(path, kind, file_hash(path))
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def _load_artifacts(company_file: str, key: tuple) -> dict | None:
+    return pipeline.load_artifacts(company_file)
+
+
+def load_artifacts(company_file: str) -> dict | None:
+    manifest_path = os.path.join(pipeline.output_dir_for(company_file), "manifest.json")
+    key = (file_hash(company_file), file_hash(pipeline.CUSTOMERS_PATH),
+           file_hash(pipeline.scraped_path_for(company_file)), file_hash(manifest_path))
+    return _load_artifacts(company_file, key)
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def preprocess_company_list(key: tuple, _df: pd.DataFrame, _current_customers: pd.DataFrame) -> pd.DataFrame:
+    """Cached data_cleaning.preprocess_company_list. key identifies the content of both inputs."""
+    return data_cleaning.preprocess_company_list(_df.copy(), _current_customers)
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def preprocess_scraped_data(key: tuple, _df: pd.DataFrame, _current_customers: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Cached data_cleaning.preprocess_scraped_data. key identifies the content of both inputs.
+    Returns the raw data with the cleaned names and the preprocessed data.
+    """
+    df_raw = _df.copy()
+    return df_raw, data_cleaning.preprocess_scraped_data(df_raw, _current_customers)
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def build_lead_table(
+        key: tuple,
+        _df_company_data: pd.DataFrame,
+        _df_xing_raw: pd.DataFrame,
+        _df_xing: pd.DataFrame,
+        _current_customers: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Cached matching.build_lead_table. key identifies the content of all inputs.
+    Returns all companies, the ranked leads and the additional companies from the scraped data.
+    """
+    df_company_data, leads = matching.build_lead_table(_df_company_data, _df_xing, _current_customers)
+    return df_company_data, leads, matching.additional_companies(_df_xing_raw, df_company_data)
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def clusterings(key: tuple, _data: pd.DataFrame) -> dict:
+    """
+    Cached ml_functions.precompute_clusterings for all numbers of clusters. key identifies the content of the data.
+    Fitted models are also kept in ml_functions.model_cache, which is reused across restarts and for extended lists.
+    """
+    return ml_functions.precompute_clusterings(_data, mode="auto", cache=ml_functions.model_cache)
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def top_k_index(key: tuple, _df_company_data: pd.DataFrame, k: int, sort_by: tuple) -> matching.TopKIndex:
+    """Cached matching.TopKIndex. key identifies the matched companies and the clustering."""
+    return matching.TopKIndex(_df_company_data, _df_company_data["Cluster labels"], k, list(sort_by))
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def cluster_scores(key: tuple, _clusterings: dict) -> pd.DataFrame:
+    """Cached ml_functions.cluster_scores. key identifies the content of the clustered data."""
+    return ml_functions.cluster_scores(_clusterings)
+
+
+@st.cache_resource(max_entries=MAX_ENTRIES, show_spinner=False)
+def plot_clusters_2d(key: tuple, _df, _kmeans, _scaler, _current_customers):
+    """Cached ml_functions.plot_clusters_2d. key identifies the clustering and the current customers."""
+    return ml_functions.plot_clusters_2d(_df, _kmeans, _scaler, _current_customers)
+
+
+@st.cache_resource(max_entries=MAX_ENTRIES, show_spinner=False)
+def violin_plots(key: tuple, _df):
+    """Cached ml_functions.violin_plots. key identifies the clustering."""
+    return ml_functions.violin_plots(_df)
+
+
+@st.cache_resource(max_entries=MAX_ENTRIES, show_spinner=False)
+def industry_histogram(key: tuple, _company_data_selection, _current_customers):
+    """Cached ml_functions.industry_histogram. key identifies the leads and the current customers."""
+    return ml_functions.industry_histogram(_company_data_selection, _current_customers)
+
+
+@st.cache_resource(max_entries=MAX_ENTRIES, show_spinner=False)
+def top_ads_bar(key: tuple, _company_data_selection):
+    """Cached ml_functions.top_ads_bar. key identifies the leads."""
+    return ml_functions.top_ads_bar(_company_data_selection)
+
+
+@st.cache_data(max_entries=MAX_ENTRIES, show_spinner=False)
+def venn_diagram(subsets: tuple, set_labels: tuple) -> bytes:
+    """Renders the Venn diagram of the company list and the scraped companies as PNG."""
+    fig = plt.figure(figsize=(4, 4))
+    venn2(subsets=subsets, set_labels=set_labels)
+    png = BytesIO()
+    fig.savefig(png, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return png.getvalue()
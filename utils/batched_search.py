@@ -0,0 +1,249 @@
+"""
+Batched search mode of the scrapers.
+
+Instead of one search per company, several companies are combined into one OR query, or all ads are read
+with one broad sweep. The company names of the job teasers found are matched locally to the searched
+companies with the same normalization and edit distance as the spellings joined in the scraped data.
+Every company then gets its own result, so the results are stored and exported like those of the
+per-company search. Teasers of other companies are stored under a key of their own (see other_key), so they
+never change the result of a searched company.
+
+The coverage of both modes for a list of companies scraped in both modes can be compared with
+    python -m utils.batched_search data/company_data/<file>.xlsx
+"""
+import argparse
+import json
+import os
+from collections import defaultdict
+from collections.abc import Callable
+import Levenshtein as lev
+import pandas as pd
+from utils.data_chunks import CACHE_PATH
+from utils.fuzzy_grouping import deletion_keys
+from utils.name_normalizer import normalizer
+from utils.result_store import ScrapeStore
+from utils.telemetry import TELEMETRY_DIR
+
+BATCH_SIZE = 20
+MAX_QUERY_LENGTH = 400  # Characters of the combined company names in one query
+
+
+def or_query(companies: list[str]) -> str:
+    """Combines company names to one query, e.g. '("Acme GmbH" OR Bosch)'."""
+    terms = [f'"{c}"' if " " in c else c for c in companies]
+    return "(" + " OR ".join(terms) + ")" if len(terms) > 1 else terms[0]
+
+
+def query_companies(query: str) -> list[str]:
+    """Returns the company names of a query, the reverse of or_query. A plain company name is returned as it is."""
+    if query.startswith("(") and query.endswith(")") and " OR " in query:
+        query = query[1:-1]
+    return [term[1:-1] if len(term) > 1 and term[0] == term[-1] == '"' else term for term in query.split(" OR ")]
+
+
+def batches(companies: list[str], batch_size: int = BATCH_SIZE, max_length: int = MAX_QUERY_LENGTH) -> list[list[str]]:
+    """Splits companies into batches of at most batch_size names and max_length characters."""
+    result, batch, length = [], [], 0
+    for c in companies:
+        if batch and (len(batch) == batch_size or length + len(c) > max_length):
+            result.append(batch)
+            batch, length = [], 0
+        batch.append(c)
+        length += len(c) + 6
+    if batch:
+        result.append(batch)
+    return result
+
+
+def company_matcher(companies: list[str], max_distance: int = 1) -> Callable[[str], str | None]:
+    """
+    Returns a function that finds the company a company name of a job teaser belongs to, or None.
+
+    A name matches a company if their normalized names are equal, or else if they are within a Levenshtein
+    distance of max_distance, like the spellings joined in data_cleaning. Unlike there, the companies are not
+    grouped with each other, so similar names in one batch keep their own results.
+    """
+    exact = {}
+    blocks = defaultdict(list)
+    for c in companies:
+        name = normalizer.normalize(c)
+        if isinstance(name, str):
+            exact.setdefault(name, c)
+            for key in deletion_keys(name, max_distance):
+                blocks[key].append((name, c))
+
+    def match(found: str) -> str | None:
+        name = normalizer.normalize(found)
+        if not isinstance(name, str):
+            return None
+        if name in exact:
+            return exact[name]
+        candidates = {candidate for key in deletion_keys(name, max_distance) for candidate in blocks.get(key, [])}
+        distances = [(lev.distance(name, n), n, c) for n, c in candidates]
+        distances = [d for d in distances if d[0] <= max_distance]
+        return min(distances)[2] if distances else None
+
+    return match
+
+
+def other_key(query: str) -> str:
+    """Result cache key of the teasers of a query that match none of the searched companies."""
+    return f"[other companies] {query}"
+
+
+def match_companies(
+        found: list[str],
+        companies: list[str],
+        other: str | None = None,
+        max_distance: int = 1) -> dict[str, list[str]]:
+    """
+    Assigns the company names of the job teasers found to the searched companies (see company_matcher).
+    Teasers of other companies are assigned to the key other, e.g. other_key(query), or dropped if it is None.
+
+    Returns:
+    dict: The company names found for every searched company, and for other if some match none of them.
+    """
+    match = company_matcher(companies, max_distance)
+    results = {c: [] for c in companies}
+    for f in found:
+        company = match(f) or other
+        if company is not None:
+            results.setdefault(company, []).append(f)
+    return results
+
+
+def batched_search(
+        companies: list[str],
+        search: Callable[[str], list[str] | None],
+        on_result: Callable[[str, list[str]], None] | None = None,
+        batch_size: int = BATCH_SIZE,
+        page_size: int | None = None,
+        map_function: Callable = map) -> list[str]:
+    """
+    Searches for the companies in batches and returns the company names of all ads found.
+
+    Parameters:
+    companies (list): Companies to search for.
+    search (callable): Returns the company names found for a query, or None if the search failed.
+    on_result (callable): Called with every company of a successful batch and the company names matched to it,
+        like in the scrapers, and with other_key(query) and the company names matching none of them, if any.
+    batch_size (int): Maximum number of companies in one query.
+    page_size (int): Number of results that fit on the result page read by search. A batch with page_size results
+        or more may be cut off, so it is split into the companies found and the others, or in halves if that
+        doesn't split it, and searched again until single companies are left.
+    map_function (callable): Runs search on a list of queries, e.g. ThreadPoolExecutor.map for parallel searches.
+
+    Returns:
+    list: Company names of all ads found.
+    """
+    company_list = []
+    pending = batches(companies, batch_size)
+    while pending:
+        split = []
+        queries = [or_query(batch) for batch in pending]
+        for batch, query, found in zip(pending, queries, map_function(search, queries)):
+            if found is None:
+                continue
+            matches = match_companies(found, batch, other_key(query))
+            if page_size is not None and len(found) >= page_size and len(batch) > 1:
+                # Companies with many ads fill the page, so they are searched apart from those not found yet
+                seen = [c for c in batch if matches[c]]
+                unseen = [c for c in batch if not matches[c]]
+                if not seen or not unseen:
+                    seen, unseen = batch[:len(batch) // 2], batch[len(batch) // 2:]
+                split += [seen, unseen]
+                continue
+            company_list.extend(found)
+            if on_result is not None:
+                for c, matched in matches.items():
+                    on_result(c, matched)
+        pending = split
+    return company_list
+
+
+def coverage_report(
+        companies: list[str],
+        cache_path: str = CACHE_PATH,
+        per_company_source: str = "xing",
+        batched_source: str = "xing_batched") -> pd.DataFrame:
+    """
+    Compares the results of the per-company and the batched search for the same companies, as stored in the
+    result cache under the two sources. Only companies searched in both modes are compared.
+
+    Returns:
+    pd.DataFrame: Number of ads matched to every company in both modes.
+    """
+    per_company = ScrapeStore(cache_path, per_company_source)
+    batched = ScrapeStore(cache_path, batched_source)
+    missing = set(per_company.missing(companies)) | set(batched.missing(companies))
+    companies = [c for c in companies if c not in missing]
+    df = pd.DataFrame({"Company": companies})
+    df["lowercase_company"] = normalizer.normalize_series(df["Company"])
+    for column, store in [("Ads (per company)", per_company), ("Ads (batched)", batched)]:
+        counts = store.counts(companies)
+        counts["lowercase_company"] = normalizer.normalize_series(counts["Company"])
+        ads = counts.groupby("lowercase_company")["count"].sum()
+        df[column] = df["lowercase_company"].map(ads).fillna(0).astype(int)
+    return df.drop(columns="lowercase_company")
+
+
+def page_loads(
+        sources: list[str],
+        companies: list[str],
+        path: str = os.path.join(TELEMETRY_DIR, "scraper.jsonl"),
+        runs: list[str] | None = None) -> dict[str, int]:
+    """
+    Returns the number of result pages loaded per source by the searches for the companies, as recorded by the
+    scrapers in the telemetry. Queries that also searched for other companies are not counted. Every scrape of
+    the companies is counted, unless only the given telemetry runs are.
+    """
+    loads = dict.fromkeys(sources, 0)
+    companies = set(companies)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                query = json.loads(line)
+                if (query["source"] in loads and query["error"] is None and (runs is None or query["run"] in runs)
+                        and companies.issuperset(query_companies(query["company"]))):
+                    loads[query["source"]] += query["pages"]
+    return loads
+
+
+def print_coverage(report: pd.DataFrame, loads: dict[str, int]):
+    """Prints how many companies with ads both modes found and how many result pages they loaded."""
+    with_ads = report["Ads (per company)"] > 0
+    with_ads_batched = report["Ads (batched)"] > 0
+    both = (with_ads & with_ads_batched).sum()
+    print(f"Companies compared: {len(report)}")
+    print(f"Companies with ads, per company: {with_ads.sum()}, batched: {with_ads_batched.sum()}, both: {both}")
+    if with_ads.any():
+        print(f"Coverage of the batched search: {both / with_ads.sum():.1%} of the companies, "
+              f"{report['Ads (batched)'].sum() / max(1, report['Ads (per company)'].sum()):.1%} of the ads")
+    print("Result pages loaded: " + ", ".join(f"{source}: {n}" for source, n in loads.items()))
+    missed = report[with_ads & ~with_ads_batched]
+    if len(missed):
+        print("Companies only found per company:")
+        print(missed.to_string(index=False))
+
+
+def main():
+    from utils import dataset_catalog
+    from utils.data_cleaning import preprocess_company_list
+    from utils.pipeline import CUSTOMERS_PATH
+    parser = argparse.ArgumentParser(description="Compare the batched with the per-company search of a list of companies.")
+    parser.add_argument("company_file", help="Excel list of companies, scraped in both modes")
+    parser.add_argument("--customers", default=CUSTOMERS_PATH, help="Excel file with the current customers")
+    parser.add_argument("--source", default="xing", help="Source of the per-company search in the result cache")
+    parser.add_argument("--batched-source", default="xing_batched", help="Source of the batched search in the result cache")
+    parser.add_argument("--cache-path", default=CACHE_PATH)
+    parser.add_argument("--runs", nargs="+", help="Only count the page loads of these telemetry runs, e.g. the last scrape in each mode")
+    args = parser.parse_args()
+
+    companies = preprocess_company_list(dataset_catalog.load(args.company_file, "company_data"),
+                                        dataset_catalog.load(args.customers, "customers"))
+    report = coverage_report(companies["Company"].tolist(), args.cache_path, args.source, args.batched_source)
+    print_coverage(report, page_loads([args.source, args.batched_source], report["Company"].tolist(), runs=args.runs))
+
+
+if __name__ == "__main__":
+    main()
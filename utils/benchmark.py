@@ -0,0 +1,237 @@
+"""
+Offline benchmark of the processing stages on synthetic company lists and scraped data.
+
+Usage:
+    python -m utils.benchmark [--sizes 1000 10000 100000 1000000] [--compare data/benchmarks/<earlier>.json]
+
+For every size, a CRM export and the scraped data are generated with realistic legal suffixes,
+near-duplicate names and mixed currencies. Every stage is timed and its peak memory is measured
+in a separate run with tracemalloc, which slows down the code. The results are written to
+data/benchmarks/<commit>_<timestamp>.json, so runs of different commits can be compared.
+Nothing is scraped and no files of the app are read or written.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from utils import data_cleaning, matching, ml_functions
+from utils.name_normalizer import CompanyNameNormalizer
+from utils.telemetry import telemetry
+
+SIZES = [1000, 10000, 100000, 1000000]
+STAGES = [
+    "clean_data",
+    "clean_company_names",
+    "join_entries_for_same_companies",
+    "preprocess_company_list",
+    "build_lead_table",
+    "kmeans_clustering",
+    "plot_clusters_2d",
+]
+OUTPUT_DIR = "data/benchmarks"
+
+SYLLABLES = ["ka", "lo", "mi", "ter", "sun", "bau", "tec", "ro", "vex", "nor",
+             "dal", "fin", "gra", "hel", "mat", "pul", "sor", "wen", "zen", "bri"]
+LEGAL_SUFFIXES = ["GmbH", "AG", "SE", "KG", "GmbH & Co. KG", "Ltd", "Ltd.", "Inc", "Corp.", "LLC", "e.V.", ""]
+INDUSTRIES = ["Machinery", "Electronics", "Automotive", "Energy", "Chemicals", "Medical Devices", "Construction",
+              "Logistics", "Food & Beverages", "Plastics", "Metal Processing", "Software", "Retail", "Utilities"]
+CURRENCIES = ["EUR", "USD", "GBP", "CHF", "SEK", "PLN", "eur", "XYZ", None]
+CURRENCY_WEIGHTS = [0.55, 0.15, 0.08, 0.08, 0.04, 0.04, 0.02, 0.01, 0.03]
+
+
+def _base_names(n: int, rng: np.random.Generator) -> np.ndarray:
+    """Returns n distinct pronounceable company names without legal suffix."""
+    names = set()
+    while len(names) < n:
+        lengths = rng.integers(2, 6, n)
+        for length in lengths:
+            names.add("".join(rng.choice(SYLLABLES, length)).capitalize())
+            if len(names) == n:
+                break
+    return np.array(sorted(names), dtype=object)
+
+
+def _variants(names: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Near-duplicates as they appear in CRM exports and job ads: typos, case and whitespace."""
+    variants = names.copy()
+    for i, name in enumerate(names):
+        kind = rng.integers(4)
+        if kind == 0 and len(name) > 3:
+            position = rng.integers(1, len(name))
+            variants[i] = name[:position] + name[position + 1:]
+        elif kind == 1:
+            variants[i] = name.upper()
+        elif kind == 2:
+            variants[i] = f" {name}  "
+        else:
+            variants[i] = name + "s"
+    return variants
+
+
+def generate_company_list(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Synthetic CRM export with n rows and the columns of the real export.
+    About a third of the companies appear several times with different modification dates, and 5% of the
+    rows are near-duplicate spellings of other companies. Some revenues and employee numbers are missing.
+    """
+    rng = np.random.default_rng(seed)
+    base = _base_names(max(1, int(n * 0.7)), rng)
+    names = base + " " + rng.choice(LEGAL_SUFFIXES, len(base))
+    account_names = rng.choice(names, n)
+    near_duplicates = rng.random(n) < 0.05
+    account_names[near_duplicates] = _variants(account_names[near_duplicates], rng)
+    df = pd.DataFrame({
+        "Account Name": [name.strip() if rng.random() < 0.9 else name for name in account_names],
+        "Last Modified Date": pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 700, n), unit="D"),
+        "Industry": rng.choice(INDUSTRIES, n),
+        "Annual Revenue Currency": rng.choice(np.array(CURRENCIES, dtype=object), n, p=CURRENCY_WEIGHTS),
+        "Annual Revenue": np.round(rng.lognormal(16, 1.5, n), 2),
+        "Employees": np.round(rng.lognormal(5, 1.2, n)).clip(1),
+    })
+    df.loc[rng.random(n) < 0.05, "Annual Revenue"] = np.nan
+    df.loc[rng.random(n) < 0.05, "Employees"] = np.nan
+    return df
+
+
+def generate_customers(companies: pd.DataFrame, n: int = 200, seed: int = 0) -> pd.DataFrame:
+    """Current customers as in data/customers: a sample of the companies with revenue in USD."""
+    rng = np.random.default_rng(seed)
+    sample = companies.dropna(subset=["Annual Revenue", "Employees"]).sample(min(n, len(companies)), random_state=seed)
+    return pd.DataFrame({
+        "Company": sample["Account Name"].to_numpy(),
+        "Annual Revenue (USD)": sample["Annual Revenue"].to_numpy(),
+        "Employees": np.clip(sample["Employees"].to_numpy(), 10, None),
+        "Industry": rng.choice(INDUSTRIES, len(sample)),
+    })
+
+
+def generate_scraped_data(companies: pd.DataFrame, n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Synthetic scraped data with n rows of company names and their number of ads. Most names are spellings
+    of companies in the list, some companies are not in the list at all.
+    """
+    rng = np.random.default_rng(seed)
+    names = rng.choice(companies["Account Name"].dropna().unique(), n)
+    variants = rng.random(n) < 0.1
+    names[variants] = _variants(names[variants], rng)
+    others = rng.random(n) < 0.2
+    names[others] = _base_names(int(others.sum()), np.random.default_rng(seed + 1)) + " GmbH"
+    return pd.DataFrame({"Company": names, "count": rng.integers(1, 20, n)})
+
+
+def _measure(function, memory: bool) -> dict:
+    if memory:
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"peak_memory_mb": peak / 1e6}
+    start = time.perf_counter()
+    function()
+    return {"seconds": time.perf_counter() - start}
+
+
+def _stage_functions(companies: pd.DataFrame, customers: pd.DataFrame, scraped: pd.DataFrame) -> dict:
+    """Returns a function without arguments per stage. Inputs of later stages are prepared once, untimed."""
+    preprocessed = data_cleaning.preprocess_company_list(companies.copy(), customers)
+    scraped_names = data_cleaning.clean_company_names(scraped.copy())
+    scraped_preprocessed = data_cleaning.join_entries_for_same_companies(scraped_names.copy())
+    matched, _ = matching.build_lead_table(preprocessed, scraped_preprocessed, customers)
+    X = matched[["Annual Revenue (USD)", "Employees"]]
+    clustered, kmeans, scaler = ml_functions.kmeans_clustering(X, n_clusters=5)
+    renamed = companies.rename(columns={"Account Name": "Company"})
+    return {
+        "clean_data": lambda: data_cleaning.clean_data(companies.copy()),
+        "clean_company_names": lambda: data_cleaning.clean_company_names(renamed.copy()),
+        "join_entries_for_same_companies": lambda: data_cleaning.join_entries_for_same_companies(scraped_names.copy()),
+        "preprocess_company_list": lambda: data_cleaning.preprocess_company_list(companies.copy(), customers),
+        "build_lead_table": lambda: matching.build_lead_table(preprocessed, scraped_preprocessed, customers),
+        "kmeans_clustering": lambda: ml_functions.kmeans_clustering(X, n_clusters=5),
+        "plot_clusters_2d": lambda: ml_functions.plot_clusters_2d(clustered, kmeans, scaler, customers).to_json(),
+    }
+
+
+def run(sizes: list[int] = SIZES, stages: list[str] = STAGES, memory: bool = True, seed: int = 0) -> list[dict]:
+    """Runs the benchmark and returns one result per size and stage."""
+    # Spans of the instrumented stages are not written to the telemetry files of the app
+    telemetry.directory = None
+    # A normalizer without mapping file, so cached names of earlier runs or of the app don't affect the results
+    data_cleaning.normalizer = CompanyNameNormalizer(mapping_file=None)
+    results = []
+    for n in sizes:
+        companies = generate_company_list(n, seed)
+        customers = generate_customers(companies, seed=seed)
+        scraped = generate_scraped_data(companies, n, seed)
+        functions = _stage_functions(companies, customers, scraped)
+        for stage in stages:
+            # Every stage starts without cached normalized names
+            data_cleaning.normalizer = CompanyNameNormalizer(mapping_file=None)
+            result = {"stage": stage, "rows": n, **_measure(functions[stage], memory=False)}
+            if memory:
+                data_cleaning.normalizer = CompanyNameNormalizer(mapping_file=None)
+                result.update(_measure(functions[stage], memory=True))
+            print(f"{stage:<35} {n:>9} rows  {result['seconds']:8.3f} s"
+                  + (f"  {result['peak_memory_mb']:8.1f} MB" if memory else ""))
+            results.append(result)
+    return results
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save(results: list[dict], output_dir: str = OUTPUT_DIR) -> str:
+    """Saves the results with the commit, the time and the platform. Returns the path of the file."""
+    commit = _commit()
+    timestamp = pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"{commit}_{timestamp}.json")
+    with open(path, "w") as f:
+        json.dump({
+            "commit": commit,
+            "timestamp": timestamp,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "results": results,
+        }, f, indent=2)
+    return path
+
+
+def compare(results: list[dict], baseline_path: str) -> pd.DataFrame:
+    """Returns the results next to those of an earlier run, with the ratio of the times (> 1 is slower)."""
+    with open(baseline_path) as f:
+        baseline = pd.DataFrame(json.load(f)["results"])
+    df = pd.DataFrame(results).merge(baseline, on=["stage", "rows"], how="left", suffixes=("", " baseline"))
+    df["time ratio"] = df["seconds"] / df["seconds baseline"]
+    if "peak_memory_mb" in df and "peak_memory_mb baseline" in df:
+        df["memory ratio"] = df["peak_memory_mb"] / df["peak_memory_mb baseline"]
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the processing stages on synthetic data, without scraping.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Numbers of rows of the company list")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--no-memory", action="store_true", help="Only measure the time, which is faster")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.stages, memory=not args.no_memory, seed=args.seed)
+    print(f"Results saved to {save(results, args.output_dir)}")
+    if args.compare:
+        print(compare(results, args.compare).to_string(index=False, float_format="{:.3f}".format))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import json
+import os
+from collections.abc import Callable
+from selenium import webdriver
+
+# URL patterns that are not needed to read job ads
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.css",
+]
+
+
+class BrowserSession:
+    """
+    Long-lived Chrome session that can be shared by several calls of a scraper.
+
+    The driver is started lazily and kept alive between calls. After start, the
+    cookies saved in cookie_file are restored and setup(driver) is called, e.g. to
+    accept a cookie banner or to log in. setup should check the state of the page,
+    as it is also called when the restored cookies already contain a login.
+    The driver is recycled after max_queries queries or after an error.
+    """
+
+    def __init__(
+            self,
+            start_url: str,
+            setup: Callable[[webdriver.Chrome], None] | None = None,
+            cookie_file: str | None = None,
+            max_queries: int = 500,
+            headless: bool = True,
+            block_resources: bool = True):
+        self.start_url = start_url
+        self.setup = setup
+        self.cookie_file = cookie_file
+        self.max_queries = max_queries
+        self.headless = headless
+        self.block_resources = block_resources
+        self.n_queries = 0
+        self._driver = None
+
+    @property
+    def driver(self) -> webdriver.Chrome:
+        if self._driver is None:
+            self._driver = self._start()
+        return self._driver
+
+    def _start(self) -> webdriver.Chrome:
+        options = webdriver.ChromeOptions()
+        if self.headless:
+            options.add_argument("--headless=new")
+            options.add_argument("--window-size=1920,1080")
+        if self.block_resources:
+            options.add_experimental_option("prefs", {
+                "profile.managed_default_content_settings.images": 2,
+                "profile.managed_default_content_settings.stylesheets": 2,
+                "profile.managed_default_content_settings.fonts": 2,
+            })
+        driver = webdriver.Chrome(options=options)
+        try:
+            if not self.headless:
+                driver.maximize_window()
+            if self.block_resources:
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+
+            driver.get(self.start_url)
+            if self._restore_cookies(driver):
+                driver.get(self.start_url)
+            if self.setup is not None:
+                self.setup(driver)
+        except Exception:
+            # Otherwise the browser keeps running, as recycle() only quits the driver of a started session
+            driver.quit()
+            raise
+        self.n_queries = 0
+        self._driver = driver
+        self.save_cookies()
+        return driver
+
+    def _restore_cookies(self, driver: webdriver.Chrome) -> bool:
+        if self.cookie_file is None or not os.path.exists(self.cookie_file):
+            return False
+        with open(self.cookie_file) as f:
+            cookies = json.load(f)
+        for cookie in cookies:
+            try:
+                driver.add_cookie(cookie)
+            except Exception:
+                # Cookies of other domains can't be set on the start page
+                pass
+        return len(cookies) > 0
+
+    def save_cookies(self):
+        """Saves the cookies of the current driver, so that a later session can reuse the login."""
+        if self.cookie_file is None or self._driver is None:
+            return
+        os.makedirs(os.path.dirname(self.cookie_file) or ".", exist_ok=True)
+        # Write to a temporary file first, as several sessions may share the cookie file
+        tmp_file = f"{self.cookie_file}.{os.getpid()}.{id(self)}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._driver.get_cookies(), f)
+        os.replace(tmp_file, self.cookie_file)
+
+    def record_query(self):
+        """Counts a finished query and recycles the driver once max_queries is reached."""
+        self.n_queries += 1
+        if self.n_queries >= self.max_queries:
+            self.recycle()
+
+    def recycle(self):
+        """Quits the driver. A fresh one is started the next time the driver is used."""
+        if self._driver is None:
+            return
+        try:
+            self.save_cookies()
+        except Exception:
+            pass
+        try:
+            self._driver.quit()
+        finally:
+            self._driver = None
+
+    def quit(self):
+        self.recycle()
@@ -1,31 +1,114 @@
+import os
+import threading
 import pandas as pd
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 from utils.data_cleaning import clean_data
+from utils.rate_limit import AdaptiveRateLimiter
+from utils.result_store import ScrapeStore
+from utils.telemetry import telemetry
 
-def scrape_chunks(companies_df: pd.DataFrame, scraper: Callable, path: str, chunk_size: int = 100):
+CACHE_PATH = "data/scraped_data/scrape_cache.sqlite"
+
+def scrape_chunks(
+        companies_df: pd.DataFrame,
+        scraper: Callable,
+        path: str,
+        chunk_size: int = 100,
+        n_workers: int = 1,
+        session_factory: Callable | None = None,
+        source: str = "xing",
+        ttl: pd.Timedelta | None = pd.Timedelta(days=7),
+        cache_path: str = CACHE_PATH,
+        on_progress: Callable[[int, int], None] | None = None,
+        limiter: AdaptiveRateLimiter | None = None):
     """
     Scrape data in chunks to manage large lists of companies.
 
+    The chunks are put on a shared queue and processed by a pool of n_workers
+    threads, each driving a separate browser. If session_factory is given, every
+    worker creates one browser session with it and keeps it alive for all its
+    chunks, otherwise every call to the scraper starts its own WebDriver.
+
+    The result of every company is appended to a result cache shared by all lists
+    of companies as soon as it arrives. Only companies that are missing in the
+    cache or whose result is older than ttl are scraped, so companies scraped
+    recently and companies done before an interruption are served from the cache.
+    The Excel file is written once from the cache after all chunks are done.
+
     Args:
         companies (pd.DataFrame): DataFrame containing company names to scrape.
+        scraper (callable): The scraping function to use, e.g. xing_scraper.scraper
+            or linkedin_scraper.scraper.
+        path (str): Path of the Excel file the scraped counts are saved to.
         chunk_size (int): Number of companies to process in each chunk.
-        scraper_function (callable): The scraping function to use.
+        n_workers (int): Number of browsers scraping in parallel.
+        session_factory (callable): Creates a BrowserSession, e.g. xing_scraper.xing_session.
+        source (str): Name of the scraped website in the cache.
+        ttl (pd.Timedelta): Maximum age of cached results. None means that results never expire.
+        cache_path (str): Path of the SQLite result cache.
+        on_progress (callable): Called after every scraped company with the number of
+            companies scraped so far and the number of companies to scrape.
+        limiter (AdaptiveRateLimiter): Paces the queries of all workers and chunks together,
+            so backoff after throttling is kept for the whole scrape. Default: AdaptiveRateLimiter().
 
     """
-    companies = companies_df['Company'].sort_values().tolist()
+    store = ScrapeStore(cache_path, source)
+    all_companies = companies_df['Company'].sort_values().tolist()
+    companies = store.missing(all_companies, ttl)
     company_chunks = [companies[i:i + chunk_size] for i in range(0, len(companies), chunk_size)]
 
-    for i in range(len(company_chunks)):
-        company_list = scraper(company_chunks[i])
+    if limiter is None:
+        limiter = AdaptiveRateLimiter()
+    worker = threading.local()
+    sessions = []
+    progress_lock = threading.Lock()
+    n_done = 0
+    to_scrape = set(companies)
+
+    def on_result(company: str, found: list[str]):
+        nonlocal n_done
+        store.append(company, found)
+        if company not in to_scrape:
+            return  # e.g. the other companies of a batched query
+        with progress_lock:
+            n_done += 1
+            done = n_done
+        if on_progress is not None:
+            on_progress(done, len(companies))
 
-        df_companies = pd.DataFrame(company_list, columns=['Company'])
-        df_counts = df_companies["Company"].value_counts().sort_index().reset_index()
+    def scrape_chunk(chunk: list[str]) -> list[str]:
+        if session_factory is None:
+            return scraper(chunk, on_result=on_result, limiter=limiter)
+        if not hasattr(worker, "session"):
+            worker.session = session_factory()
+            sessions.append(worker.session)
+        return scraper(chunk, on_result=on_result, session=worker.session, limiter=limiter)
 
-        # Save scraped data to Excel
-        try:
-            df_counts_start = pd.read_excel(path)
-            df_concatenated = pd.concat([df_counts_start, df_counts])
-            df_concatenated.to_excel(path, index=False)
-        except FileNotFoundError:
-            df_counts.to_excel(path, index=False)
-        print(f"Chunk {i+1}/{len(company_chunks)} processed and saved.")
+    try:
+        with telemetry.span("scrape_chunks", source=source, companies=len(companies), n_workers=n_workers), \
+                ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+            start = perf_counter()
+            # map() hands the chunks to idle workers but yields the results in input order
+            for i, _ in enumerate(pool.map(scrape_chunk, company_chunks)):
+                print(f"Chunk {i+1}/{len(company_chunks)} processed and saved ({perf_counter() - start:.0f} s).")
+    finally:
+        for session in sessions:
+            session.quit()
+        telemetry.flush()
+
+    store.export_excel(path, all_companies)
+
+def export_scraped_data(path: str, companies: list[str], source: str = "xing", cache_path: str = CACHE_PATH) -> bool:
+    """
+    Writes the Excel file of scraped data for a list of companies from the result cache,
+    e.g. after an interrupted scrape. Returns False if none of the companies has been scraped yet.
+    """
+    if not os.path.exists(cache_path):
+        return False
+    store = ScrapeStore(cache_path, source)
+    if len(store.missing(companies)) == len(companies):
+        return False
+    store.export_excel(path, companies)
+    return True
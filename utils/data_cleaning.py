@@ -1,15 +1,25 @@
+import os
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-import Levenshtein as lev
+from utils.fuzzy_grouping import group_similar_names
+from utils.name_normalizer import normalizer
+from utils.telemetry import telemetry
 
+CURRENCY_RATES_PATH = os.path.join(os.path.dirname(__file__), "currency_rates.csv")
 
-def keep_latest_entries(df, account_names):
-    for account_name in account_names:
-        filtered_df = df[df['Account Name'] == account_name]
-        indices_to_drop = filtered_df[filtered_df["Last Modified Date"] < filtered_df["Last Modified Date"].max()].index
-        df = df.drop(index=indices_to_drop)
-    return df
+
+@telemetry.timed()
+def keep_latest_entries(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keeps only the latest entries for every "Account Name" based on "Last Modified Date".
+    Entries without date or account name are kept.
+    """
+    latest = df.groupby("Account Name")["Last Modified Date"].transform("max")
+    return df[~(df["Last Modified Date"] < latest)]
 
 
+@telemetry.timed()
 def clean_data(df: pd.DataFrame) -> pd.DataFrame:
     """
     Cleans the input DataFrame by handling missing values and removing duplicates.
@@ -24,69 +34,50 @@ def clean_data(df: pd.DataFrame) -> pd.DataFrame:
     df = df.drop_duplicates()
 
     # Fill missing values with the mean of the column
-    for column in df.select_dtypes(include=['number']).columns:
-        df.fillna({column: df[column].mean()}, inplace=True)
+    numeric_columns = df.select_dtypes(include=['number']).columns
+    df = df.fillna(df[numeric_columns].mean())
 
     # Change data type of "Last Modified Date" to datetime
     df.loc[:, "Last Modified Date"] = pd.to_datetime(df["Last Modified Date"])
 
     # For all account names that are duplicated, keep only the latest entry based on "Last Modified Date"
-    account_names = df['Account Name'].value_counts()
-    account_names_duplicated = account_names.loc[account_names > 1].index
-    account_names_duplicated.to_list()  
-    df = keep_latest_entries(df, account_names_duplicated)
+    df = keep_latest_entries(df)
 
     return df
 
+@telemetry.timed()
 def clean_company_names(df: pd.DataFrame) -> pd.DataFrame:
     """
     Cleans the company names in the DataFrame.
     The new column 'lowercase_company' is created, which contains the cleaned and lowercased company names without suffixes.
+    Names are normalized by the shared CompanyNameNormalizer, so every unique name is only processed once.
     """
     df.drop_duplicates(inplace=True)
     df["Company"] = df["Company"].str.strip()
     df["Company"] = df["Company"].str.replace('Jetzt bewerben Drucken', '')
     df.sort_values(by='Company', inplace=True)
     df.reset_index(drop=True, inplace=True)
-    df["lowercase_company"] = df["Company"].str.lower()
-    df["lowercase_company"] = df["lowercase_company"].str.replace(
-        r'\s(g?mbh|gmbh \&?\+? co kg|gmbh \&?\+? co. kg|se \&?\+? co. kg|ag|kg|ug|e.k.|e.v.|ohg|gbr|partg|partg mbb|kgaa|se|sce|ggmbh|gug|gag|gkg|eg|kgaa|gbr|llc|ltd.|ltd|inc.|inc|corp.|corp|plc|co. ltd.|co. kg|co kg|co.)*$', '', regex=True)
-    df["lowercase_company"] = df["lowercase_company"].str.replace(r'\&|\+\s?$', '', regex=True)
-    df["lowercase_company"] = df["lowercase_company"].str.replace("˚", "grad")
+    df["lowercase_company"] = normalizer.normalize_series(df["Company"])
+    normalizer.save()
 
     return df
 
+@telemetry.timed()
 def join_entries_for_same_companies(df: pd.DataFrame) -> pd.DataFrame:
     """
     Joins entries for the same companies based on the 'lowercase_company' column.
-    If two consecutive entries have a Levenshtein distance of less than 2, they are considered the same company.
-    The values of numerical columns are summed for these entries.
+    Entries within a Levenshtein distance of 1 of the representative of their group are considered the same
+    company (see fuzzy_grouping.group_similar_names). The values of numerical columns are summed for these entries.
     """
-    # Sort by lowercase company name
-    df.sort_values(by='lowercase_company', inplace=True)
-    df.reset_index(drop=True, inplace=True)
-    # Measure distance between company names:
-    df["lowercase_company_shifted"] = df["lowercase_company"].shift(-1)
-    df["company_name_distance"] = df.apply(
-        lambda x: lev.distance(x["lowercase_company"], x["lowercase_company_shifted"]) if x["lowercase_company_shifted"] is not None else None,
-        axis=1)
-    # Find indices where distance is less than 2 and replace following company name with representative:
-    prev_same = False
-    for i in df.index:
-        if df["company_name_distance"].iloc[i] < 2:
-            if prev_same == False:
-                group_name = df["lowercase_company"].iloc[i]
-                df.loc[i+1, "lowercase_company"] = group_name
-            else:
-                df.loc[i+1, "lowercase_company"] = group_name
-            prev_same = True
-        else:
-            prev_same = False
-    df.drop(columns=["lowercase_company_shifted", "company_name_distance"], inplace=True)
+    names = df["lowercase_company"].dropna().unique().tolist()
+    representatives, n_compared = group_similar_names(names, max_distance=1)
+    print(f"Compared {n_compared} pairs of company names.")
+    df["lowercase_company"] = df["lowercase_company"].map(representatives)
     df = df.groupby("lowercase_company")["count"].sum().reset_index()
 
     return df
 
+@telemetry.timed()
 def remove_outliers(df: pd.DataFrame, current_customers: pd.DataFrame) -> pd.DataFrame:
     """
     Removes outliers from the DataFrame based on current customers.
@@ -117,24 +108,50 @@ def remove_outliers(df: pd.DataFrame, current_customers: pd.DataFrame) -> pd.Dat
     df_non_outliers = df[filter_rev & filter_emp]
     return df_non_outliers
 
+@telemetry.timed()
 def preprocess_scraped_data(df: pd.DataFrame, current_customers: pd.DataFrame) -> pd.DataFrame:
 
     df = clean_company_names(df)
     df = join_entries_for_same_companies(df)
     return df
 
+@telemetry.timed()
 def preprocess_company_list(df: pd.DataFrame, current_customers: pd.DataFrame) -> pd.DataFrame:
 
     df = clean_data(df)
     df.rename(columns={"Account Name": "Company"}, inplace=True)
     df = clean_company_names(df)
-    df["Annual Revenue (USD)"] = df["Annual Revenue"].copy()
-    df["Annual Revenue (USD)"] = df.apply(_to_usd, axis=1)
+    df = convert_to_usd(df)
     df = remove_outliers(df, current_customers)
     return df
 
-def _to_usd(row):
-    if row["Annual Revenue Currency"] == "EUR":
-        return int(row["Annual Revenue"] * 1.18)  # Approx. conversion rate
-    else:
-        return row["Annual Revenue"]
\ No newline at end of file
+@lru_cache
+def load_currency_rates(path: str = CURRENCY_RATES_PATH) -> pd.Series:
+    """
+    Loads the table of approximate conversion rates (USD per unit of each currency) once.
+    """
+    rates = pd.read_csv(path, index_col="currency")["usd_per_unit"]
+    rates.index = rates.index.str.upper()
+    return rates
+
+@telemetry.timed()
+def convert_to_usd(df: pd.DataFrame, rates: pd.Series | None = None) -> pd.DataFrame:
+    """
+    Adds the column "Annual Revenue (USD)" by converting "Annual Revenue" with the rate of "Annual Revenue Currency".
+    Rows without currency are assumed to be in USD. Currencies missing in the rate table are not converted
+    and flagged in the column "Unknown currency".
+    """
+    if rates is None:
+        rates = load_currency_rates()
+    # Look up the rate once per distinct currency and broadcast it to the rows
+    codes, currencies = pd.factorize(df["Annual Revenue Currency"])
+    currencies = pd.Index(currencies.astype(str)).str.strip().str.upper()
+    currency_rates = currencies.map(rates).to_numpy(dtype=float)
+    unknown = np.isnan(currency_rates)
+    # Missing currencies (code -1) get rate 1
+    rate = np.append(np.where(unknown, 1.0, currency_rates), 1.0)[codes]
+    df["Unknown currency"] = np.append(unknown, False)[codes]
+    df["Annual Revenue (USD)"] = df["Annual Revenue"].to_numpy() * rate
+    if unknown.any():
+        print(f"Unknown currencies, revenue not converted: {sorted(currencies[unknown])}")
+    return df
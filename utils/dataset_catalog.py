@@ -0,0 +1,241 @@
+"""
+Columnar sidecars for the Excel files under data/company_data, data/customers and data/scraped_data.
+
+Every Excel file is parsed only once: its content is written to a typed Arrow IPC file in SIDECAR_DIR
+and recorded in the catalog. Later loads memory-map the sidecar instead of parsing the Excel file
+again. A sidecar is rebuilt when the modification time or size of its Excel file changes.
+The Excel files stay the source of truth, so they can still be shared with the sales team.
+"""
+import hashlib
+import json
+import os
+import threading
+from array import array
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from openpyxl import load_workbook
+from utils.telemetry import telemetry
+
+KINDS = {
+    "company_data": "data/company_data",
+    "customers": "data/customers",
+    "scraped_data": "data/scraped_data",
+}
+SIDECAR_DIR = "data/columnar"
+CATALOG_PATH = os.path.join(SIDECAR_DIR, "catalog.json")
+REQUIRED_COLUMNS = ["Account Name", "Last Modified Date", "Industry", "Annual Revenue Currency", "Annual Revenue", "Employees"]
+CATEGORICAL_COLUMNS = ["Industry", "Annual Revenue Currency"]
+NUMERIC_COLUMNS = ["Annual Revenue", "Employees"]
+HEADER_SEARCH_ROWS = 5
+_lock = threading.Lock()
+
+
+def _number(value, column: str, row: int) -> float:
+    if value is None or value == "":
+        return np.nan
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        return float(str(value).replace(",", ""))
+    except ValueError:
+        raise ValueError(f"Row {row}: '{value}' in column '{column}' is not a number") from None
+
+
+def _find_header(rows) -> tuple[int, list]:
+    """Returns the row number and the cells of the first row that contains all REQUIRED_COLUMNS."""
+    best = []
+    for row_number, cells in enumerate(rows, start=1):
+        header = [str(cell).strip() if cell is not None else None for cell in cells]
+        if set(REQUIRED_COLUMNS) <= set(header):
+            return row_number, header
+        if len(set(REQUIRED_COLUMNS) & set(header)) > len(set(REQUIRED_COLUMNS) & set(best)):
+            best = header
+        if row_number == HEADER_SEARCH_ROWS:
+            break
+    missing = [column for column in REQUIRED_COLUMNS if column not in best]
+    raise ValueError(f"Required columns are missing: {', '.join(missing)}")
+
+
+@telemetry.timed()
+def read_company_list(file) -> pd.DataFrame:
+    """
+    Reads an Excel list of companies row by row, without loading the whole sheet into memory.
+
+    The header is searched in the first HEADER_SEARCH_ROWS rows and must contain all REQUIRED_COLUMNS.
+    Every value of NUMERIC_COLUMNS is validated while reading. The columns are built with compact dtypes:
+    CATEGORICAL_COLUMNS as categoricals and "Employees" as the smallest integer type if it has no gaps.
+    "Annual Revenue" stays float64, as float32 would round revenues above 16 million.
+
+    Parameters:
+    file: Path or file-like object of the Excel file, e.g. an uploaded file.
+
+    Returns:
+    pd.DataFrame: List of companies with one row per non-empty row of the first sheet.
+    """
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header_row, header = _find_header(rows)
+        columns = {}
+        for i, name in enumerate(header):
+            if name is None or name in columns.values():
+                continue
+            columns[i] = name
+        numeric = {i: array("d") for i, name in columns.items() if name in NUMERIC_COLUMNS}
+        codes = {i: array("i") for i, name in columns.items() if name in CATEGORICAL_COLUMNS}
+        categories = {i: {} for i in codes}
+        values = {i: [] for i in columns if i not in numeric and i not in codes}
+        for row_number, cells in enumerate(rows, start=header_row + 1):
+            if all(cell is None for cell in cells):
+                continue
+            cells = cells + (None,) * (len(header) - len(cells))
+            for i, column in numeric.items():
+                column.append(_number(cells[i], columns[i], row_number))
+            for i, column in codes.items():
+                value = cells[i]
+                column.append(-1 if value is None else categories[i].setdefault(value, len(categories[i])))
+            for i, column in values.items():
+                column.append(cells[i])
+    finally:
+        workbook.close()
+
+    data = {}
+    for i, name in columns.items():
+        if i in numeric:
+            column = np.frombuffer(numeric.pop(i), dtype=np.float64)
+            if name == "Employees" and not np.isnan(column).any() and (column == np.round(column)).all():
+                column = pd.to_numeric(column, downcast="integer")
+            data[name] = column
+        elif i in codes:
+            data[name] = pd.Categorical.from_codes(np.frombuffer(codes.pop(i), dtype=np.int32), list(categories[i]))
+        else:
+            data[name] = pd.Series(values.pop(i), dtype=object)
+    df = pd.DataFrame(data)
+    try:
+        df["Last Modified Date"] = pd.to_datetime(df["Last Modified Date"])
+    except (ValueError, TypeError):
+        pass  # Converted in data_cleaning.clean_data
+    return df
+
+
+READERS = {
+    "company_data": read_company_list,
+    "customers": pd.read_excel,
+    "scraped_data": pd.read_excel,
+}
+
+
+def _signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _read_catalog() -> dict:
+    if not os.path.exists(CATALOG_PATH):
+        return {}
+    with open(CATALOG_PATH) as f:
+        return json.load(f)
+
+
+def _write_catalog(catalog: dict):
+    os.makedirs(SIDECAR_DIR, exist_ok=True)
+    tmp_file = f"{CATALOG_PATH}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(catalog, f, indent=2)
+    os.replace(tmp_file, CATALOG_PATH)
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    """Converts df to an Arrow table. Object columns with mixed types, e.g. dates and text, are stored as text."""
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def sidecar_path(path: str, kind: str) -> str:
+    """Sidecar of the Excel file at path. Files with the same name in different directories get their own sidecar."""
+    path_hash = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    return os.path.join(SIDECAR_DIR, kind, f"{os.path.splitext(os.path.basename(path))[0]}_{path_hash}.arrow")
+
+
+@telemetry.timed()
+def ingest(path: str, kind: str, df: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Converts the Excel file at path to its sidecar and records it in the catalog.
+
+    Parameters:
+    path (str): Excel file.
+    kind (str): One of KINDS, which determines how the Excel file is read.
+    df (pd.DataFrame): Content of the Excel file if it has already been read, e.g. right after an upload.
+
+    Returns:
+    pd.DataFrame: Content of the Excel file.
+    """
+    if df is None:
+        df = READERS[kind](path)
+    table = _to_arrow(df)
+    sidecar = sidecar_path(path, kind)
+    os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+    # Several sessions of the app may ingest the same file at once, each one writes its own temporary file
+    tmp_file = f"{sidecar}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # Uncompressed Arrow IPC files can be memory-mapped without decoding
+    with pa.OSFile(tmp_file, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_file, sidecar)
+    with _lock:
+        catalog = _read_catalog()
+        catalog[path] = {
+            "kind": kind,
+            "sidecar": sidecar,
+            "source": _signature(path),
+            "rows": table.num_rows,
+            "columns": table.schema.names,
+            "ingested_at": pd.Timestamp.now().isoformat(),
+        }
+        _write_catalog(catalog)
+    return df
+
+
+def is_current(path: str, entry: dict | None) -> bool:
+    """Whether the catalog entry of path exists and matches the current Excel file."""
+    return (entry is not None and os.path.exists(path) and entry["sidecar"] == sidecar_path(path, entry["kind"])
+            and os.path.exists(entry["sidecar"]) and entry["source"] == _signature(path))
+
+
+@telemetry.timed()
+def load(path: str, kind: str) -> pd.DataFrame:
+    """Loads the Excel file at path from its memory-mapped sidecar, which is created or rebuilt if needed."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    entry = _read_catalog().get(path)
+    if not is_current(path, entry):
+        return ingest(path, kind)
+    with pa.memory_map(entry["sidecar"], "r") as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def list_datasets(kind: str) -> list[dict]:
+    """
+    Returns the catalog entries of all Excel files of the given kind, sorted by file name.
+    Excel files that have been added or changed outside of the app are ingested first.
+    Files that cannot be read are listed with the error instead of a catalog entry.
+    """
+    directory = KINDS[kind]
+    catalog = _read_catalog()
+    paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".xlsx"))
+    errors = {}
+    for path in paths:
+        if not is_current(path, catalog.get(path)):
+            try:
+                ingest(path, kind)
+            except Exception as e:
+                print(f"Could not read {path}: {e}")
+                errors[path] = str(e)
+    catalog = _read_catalog()
+    return [dict(path=path, name=os.path.basename(path), error=errors[path]) if path in errors
+            else dict(catalog[path], path=path, name=os.path.basename(path)) for path in paths]
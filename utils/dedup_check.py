@@ -0,0 +1,88 @@
+"""
+Equivalence check of data_cleaning.keep_latest_entries against its earlier implementation.
+
+The earlier implementation filtered and dropped the rows of every duplicated account one by one. It is kept
+here as the reference, and both are run on random CRM-like corpora with duplicated accounts, missing account
+names, missing dates (NaT) and dates given as strings:
+    python -m utils.dedup_check [--corpora 200] [--rows 1000]
+
+Nothing is read or written, a difference is printed and the check exits with an error.
+"""
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+from utils.data_cleaning import keep_latest_entries
+from utils.telemetry import telemetry
+
+DATE_KINDS = ["datetime", "string"]
+
+
+def reference_keep_latest_entries(df: pd.DataFrame) -> pd.DataFrame:
+    """Earlier implementation of keep_latest_entries, including the selection of duplicated accounts in clean_data."""
+    account_names = df['Account Name'].value_counts()
+    account_names_duplicated = account_names.loc[account_names > 1].index
+    for account_name in account_names_duplicated:
+        filtered_df = df[df['Account Name'] == account_name]
+        indices_to_drop = filtered_df[filtered_df["Last Modified Date"] < filtered_df["Last Modified Date"].max()].index
+        df = df.drop(index=indices_to_drop)
+    return df
+
+
+def random_corpus(rows: int, dates: str = "datetime", seed: int = 0) -> pd.DataFrame:
+    """
+    Returns a random company list with many duplicated accounts and repeated dates.
+
+    With dates="datetime", some account names are missing and some dates are NaT. With dates="string",
+    the dates are ISO strings as read from an unparsed export and only account names are missing,
+    because the earlier implementation cannot compare strings with missing values.
+    """
+    rng = np.random.default_rng(seed)
+    names = pd.Series([f"Company {i}" for i in rng.integers(0, max(1, rows // 3), rows)], dtype=object)
+    names[rng.random(rows) < 0.05] = np.nan
+    days = pd.to_datetime("2020-01-01") + pd.to_timedelta(rng.integers(0, 60, rows), unit="D")
+    if dates == "string":
+        last_modified = pd.Series(days.strftime("%Y-%m-%d"), dtype=object)
+    else:
+        last_modified = pd.Series(days)
+        last_modified[rng.random(rows) < 0.05] = pd.NaT
+    # Not a RangeIndex, like the rows left over after drop_duplicates in clean_data
+    index = np.sort(rng.choice(rows * 2, rows, replace=False))
+    return pd.DataFrame({
+        "Account Name": names.to_numpy(),
+        "Last Modified Date": last_modified.to_numpy(),
+        "Employees": rng.integers(1, 10000, rows),
+    }, index=index)
+
+
+def check(corpora: int = 200, rows: int = 1000) -> list[str]:
+    """Compares both implementations on random corpora and returns a description of every difference."""
+    failures = []
+    for seed in range(corpora):
+        for dates in DATE_KINDS:
+            df = random_corpus(rows, dates, seed)
+            try:
+                pd.testing.assert_frame_equal(keep_latest_entries(df), reference_keep_latest_entries(df))
+            except AssertionError as e:
+                failures.append(f"Corpus {seed} with {dates} dates: {e}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check keep_latest_entries against its earlier implementation.")
+    parser.add_argument("--corpora", type=int, default=200, help="Number of random corpora per kind of dates")
+    parser.add_argument("--rows", type=int, default=1000, help="Rows of every corpus")
+    args = parser.parse_args()
+
+    # Spans of the checked function are not written to the telemetry files of the app
+    telemetry.directory = None
+    failures = check(args.corpora, args.rows)
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print(f"keep_latest_entries matches the earlier implementation on {args.corpora * len(DATE_KINDS)} corpora.")
+
+
+if __name__ == "__main__":
+    main()
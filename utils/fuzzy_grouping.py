@@ -0,0 +1,76 @@
+from collections import defaultdict
+from itertools import combinations
+import Levenshtein as lev
+
+MIN_FUZZY_LENGTH = 5
+
+
+def deletion_keys(name: str, max_distance: int = 1) -> set[str]:
+    """
+    Returns the name itself and all strings that result from deleting up to max_distance characters.
+    Two names with a Levenshtein distance of at most max_distance always share at least one key.
+    """
+    keys = {name}
+    current = {name}
+    for _ in range(max_distance):
+        current = {s[:i] + s[i + 1:] for s in current for i in range(len(s))}
+        keys |= current
+    return keys
+
+
+def candidate_pairs(names: list[str], max_distance: int = 1) -> set[tuple[int, int]]:
+    """
+    Blocking index: returns the index pairs (i, j) with i < j of all names that share a deletion key.
+    Only these pairs can be within max_distance, so all other pairs don't need to be compared.
+    """
+    buckets = defaultdict(list)
+    for i, name in enumerate(names):
+        for key in deletion_keys(name, max_distance):
+            buckets[key].append(i)
+    pairs = set()
+    for indices in buckets.values():
+        if len(indices) > 1:
+            pairs.update(combinations(indices, 2))
+    return pairs
+
+
+def group_similar_names(
+        names: list[str],
+        max_distance: int = 1,
+        preferred: list[str] | None = None) -> tuple[dict[str, str], int]:
+    """
+    Groups names that are within max_distance of the representative of their group.
+
+    Only candidate pairs from a blocking index on deletion keys are compared.
+    Names shorter than MIN_FUZZY_LENGTH are only grouped with equal names, as one edit turns a short name
+    into a different company (e.g. "abb" and "ibb").
+    Representatives are chosen greedily: the preferred names first, each of which keeps its own group,
+    then the alphabetically first name that is not in a group yet. Every other name joins the closest
+    representative, so names are not chained into groups of names that differ in more than max_distance.
+
+    Returns a mapping from every name to the representative of its group and the number of compared pairs.
+    """
+    preferred = list(dict.fromkeys(preferred or []))
+    names = list(dict.fromkeys(preferred + sorted(names)))
+    long_names = [i for i, name in enumerate(names) if len(name) >= MIN_FUZZY_LENGTH]
+    pairs = candidate_pairs([names[i] for i in long_names], max_distance)
+
+    neighbours = defaultdict(list)
+    for i, j in pairs:
+        i, j = long_names[i], long_names[j]
+        distance = lev.distance(names[i], names[j])
+        if distance <= max_distance:
+            neighbours[i].append((distance, j))
+            neighbours[j].append((distance, i))
+
+    # names is ordered by priority: preferred names, then alphabetically
+    is_representative = [False] * len(names)
+    for i in range(len(names)):
+        is_representative[i] = i < len(preferred) or not any(is_representative[j] for _, j in neighbours[i])
+    representative = list(range(len(names)))
+    for i, candidates in neighbours.items():
+        if not is_representative[i]:
+            representative[i] = min((distance, j) for distance, j in candidates if is_representative[j])[1]
+
+    representatives = {name: names[representative[i]] for i, name in enumerate(names)}
+    return representatives, len(pairs)
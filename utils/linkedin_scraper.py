@@ -1,5 +1,6 @@
 import pandas as pd
 import os
+from collections.abc import Callable
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -7,81 +8,262 @@ import urllib.parse
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
-from time import sleep
+from selenium.common.exceptions import TimeoutException
+from time import perf_counter
+from utils.batched_search import BATCH_SIZE, batched_search, company_matcher, match_companies, other_key
+from utils.browser_session import BrowserSession
+from utils.rate_limit import AdaptiveRateLimiter
+from utils.telemetry import telemetry
 from dotenv import load_dotenv
 load_dotenv()
 
-def read_company_names(company_list, driver):
-    company = driver.find_elements(
-        By.XPATH, "//div[contains(@class,'artdeco-entity-lockup__subtitle')]//span[normalize-space()]")
-    for c in company:
-        if c.text:
-            company_list.append(c.text)
+COMPANY_XPATH = "//div[contains(@class,'artdeco-entity-lockup__subtitle')]//span[normalize-space()]"
+# Job id and company name of every job card rendered on the page, read in one round trip to the browser.
+# Cards outside the viewport are only placeholders without company name until they are scrolled into view.
+JOB_CARDS_SCRIPT = """
+return Array.from(document.querySelectorAll('[data-occludable-job-id], [data-job-id]')).map(card => {
+    const company = card.querySelector('.artdeco-entity-lockup__subtitle span');
+    return [card.getAttribute('data-occludable-job-id') || card.getAttribute('data-job-id'),
+            company ? company.innerText.trim() : ''];
+});
+"""
+
+def read_job_cards(driver, seen: set[str]) -> list[str]:
+    """
+    Returns the company names of the job cards on the page whose job id is not in seen, and adds their ids to seen.
+    Cards that are not rendered yet are skipped, so they are read after the next scroll.
+    """
+    company_list = []
+    for job_id, company in driver.execute_script(JOB_CARDS_SCRIPT) or []:
+        if job_id and company and job_id not in seen:
+            seen.add(job_id)
+            company_list.append(company)
     return company_list
 
-def read_all_pages(company_list, driver, company_name=""):
+def wait_for_new_results(driver, previous_results: list, timeout: float = 10):
+    """
+    Waits until the results shown before a search or page change have been replaced
+    and the new results are rendered. Returns without error if there are no results.
+    """
+    try:
+        if previous_results:
+            WebDriverWait(driver, timeout, poll_frequency=0.1).until(EC.staleness_of(previous_results[0]))
+        WebDriverWait(driver, timeout / 2, poll_frequency=0.1).until(
+            EC.presence_of_element_located((By.XPATH, COMPANY_XPATH)))
+    except TimeoutException:
+        pass
+
+def read_all_pages(company_list, driver, company_name="", targets: list[str] | None = None, max_pages: int = 100):
+    """
+    Searches for service technician ads of a company and reads the company names of all result pages.
+
+    Every job card is read once, keyed by its job id, while the page is scrolled. Pagination stops early
+    when a page has no new job cards, or, if targets are given, none of the companies of its new cards
+    is one of the targets, as the results are sorted by relevance.
+    Returns the extended company_list and the number of pages visited.
+    """
 
     # Enter search term into search field
     search_term = f"service technician {company_name}"
     search_input = WebDriverWait(driver, 10).until(
         EC.presence_of_element_located((By.XPATH, '//input[@data-testid="typeahead-input"]'))
     )
+    previous_url = driver.current_url
+    previous_results = driver.find_elements(By.XPATH, COMPANY_XPATH)
     search_input.send_keys(search_term)
     search_input.send_keys(Keys.ENTER)
+    WebDriverWait(driver, 10, poll_frequency=0.1).until(EC.url_changes(previous_url))
+    wait_for_new_results(driver, previous_results)
 
-    for i in range(100):
+    match = company_matcher(targets) if targets else None
+    seen = set()
+    pages = 0
+    for i in range(max_pages):
 
-        company_list = read_company_names(company_list, driver)
+        pages += 1
+        new_companies = read_job_cards(driver, seen)
         driver.execute_script("window.scrollTo(0, document.body.scrollHeight/2);")
-        # sleep(0.5)
-        company_list = read_company_names(company_list, driver)
+        new_companies += read_job_cards(driver, seen)
         driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        # sleep(0.5)
-        company_list = read_company_names(company_list, driver)
+        new_companies += read_job_cards(driver, seen)
+        company_list.extend(new_companies)
+        if not new_companies or (match is not None and not any(match(c) for c in new_companies)):
+            break
 
         wait = WebDriverWait(driver, 6)
         try:
             next_button = wait.until(
                 EC.element_to_be_clickable((By.XPATH, "//button[contains(@class,'jobs-search-pagination__button--next')]"))
             )
+            previous_results = driver.find_elements(By.XPATH, COMPANY_XPATH)
             next_button.click()
-            sleep(1)
+            wait_for_new_results(driver, previous_results)
         except Exception:
             print(f"Exiting for loop")
             break
-    return company_list
-
-def scraper(
-        companies: list[str],
-        email_address: str = os.environ['EMAIL'],
-        pw: str = os.environ['PASSWORD']
-) -> list[str]:
-
-    # Go to login page:
-    driver = webdriver.Chrome()
-    driver.get('https://www.linkedin.com/login')
-
-    if not email_address or not pw:
-        raise ValueError("Email address and password must be provided.")
+    return company_list, pages
 
-    # Log in to LinkedIn:
+def login(driver, email_address: str, pw: str):
+    """Logs in to LinkedIn unless the restored cookies already contain a login."""
+    if not driver.find_elements(By.ID, "username"):
+        return
     email = driver.find_element(By.ID, "username")
     email.send_keys(email_address)
     password = driver.find_element(By.ID, "password")
     password.send_keys(pw)
     password.submit()
 
+def linkedin_session(
+        email_address: str = os.environ['EMAIL'],
+        pw: str = os.environ['PASSWORD'],
+        cookie_file: str | None = "data/sessions/linkedin_cookies.json",
+        **kwargs
+) -> BrowserSession:
+    """Creates a logged in browser session that can be shared by several calls of scraper()."""
+    if not email_address or not pw:
+        raise ValueError("Email address and password must be provided.")
+    return BrowserSession(
+        'https://www.linkedin.com/login',
+        setup=lambda driver: login(driver, email_address, pw),
+        cookie_file=cookie_file,
+        **kwargs)
+
+def scraper(
+        companies: list[str],
+        email_address: str = os.environ['EMAIL'],
+        pw: str = os.environ['PASSWORD'],
+        on_result: Callable[[str, list[str]], None] | None = None,
+        session: BrowserSession | None = None,
+        limiter: AdaptiveRateLimiter | None = None
+) -> list[str]:
+    """
+    Searches for service technician ads of each company and returns the company names of all ads found.
+    If on_result is given, it is called after every successful search with the searched company
+    and the company names found for it.
+    If session is given, its driver is used and kept alive, otherwise a new browser is started,
+    logged in and closed again.
+    The searches are paced by limiter, which backs off after errors.
+    """
+    own_session = session is None
+    if own_session:
+        session = linkedin_session(email_address, pw, cookie_file=None, headless=False, block_resources=False)
+    if limiter is None:
+        limiter = AdaptiveRateLimiter(rate=1.0)
     company_list = []
 
     for c in companies:
+        waited = 0.0
+        start = perf_counter()
         try:
-            sleep(0.5)
+            waited = limiter.acquire(c)
+            start = perf_counter()
             url = f"https://www.linkedin.com/jobs/"
+            driver = session.driver
             driver.get(url)
-            sleep(0.25)
-            company_list = read_all_pages(company_list, driver, c)
-        except Exception:
+            n_found = len(company_list)
+            company_list, pages = read_all_pages(company_list, driver, c, targets=[c])
+            limiter.success()
+            session.record_query()
+            telemetry.record_query("linkedin", c, perf_counter() - start, waited, pages=pages,
+                                   results=len(company_list) - n_found)
+            if on_result is not None:
+                on_result(c, company_list[n_found:])
+        except Exception as e:
             print(f"Error with company {c}")
+            telemetry.record_query("linkedin", c, perf_counter() - start, waited, pages=0, error=type(e).__name__)
+            limiter.failure()
+            session.recycle()
+
+    if own_session:
+        session.quit()
+    return company_list
+
+def batch_scraper(
+        companies: list[str],
+        email_address: str = os.environ['EMAIL'],
+        pw: str = os.environ['PASSWORD'],
+        on_result: Callable[[str, list[str]], None] | None = None,
+        session: BrowserSession | None = None,
+        limiter: AdaptiveRateLimiter | None = None,
+        batch_size: int = BATCH_SIZE
+) -> list[str]:
+    """
+    Same as scraper(), but searches for up to batch_size companies at once with an OR query, which LinkedIn
+    supports in the keywords, and matches the company names found to the searched companies (see batched_search).
+    All result pages are read, so the batches don't need to be split.
+    """
+    own_session = session is None
+    if own_session:
+        session = linkedin_session(email_address, pw, cookie_file=None, headless=False, block_resources=False)
+    if limiter is None:
+        limiter = AdaptiveRateLimiter(rate=1.0)
 
-    driver.quit()
-    return company_list
\ No newline at end of file
+    def search(query: str) -> list[str] | None:
+        waited = 0.0
+        start = perf_counter()
+        try:
+            waited = limiter.acquire(query)
+            start = perf_counter()
+            driver = session.driver
+            driver.get("https://www.linkedin.com/jobs/")
+            found, pages = read_all_pages([], driver, query)
+        except Exception as e:
+            print(f"Error with query {query}")
+            telemetry.record_query("linkedin_batched", query, perf_counter() - start, waited, pages=0, error=type(e).__name__)
+            limiter.failure()
+            session.recycle()
+            return None
+        limiter.success()
+        session.record_query()
+        telemetry.record_query("linkedin_batched", query, perf_counter() - start, waited, pages=pages, results=len(found))
+        return found
+
+    company_list = batched_search(companies, search, on_result, batch_size)
+    if own_session:
+        session.quit()
+    return company_list
+
+def sweep_scraper(
+        companies: list[str],
+        email_address: str = os.environ['EMAIL'],
+        pw: str = os.environ['PASSWORD'],
+        on_result: Callable[[str, list[str]], None] | None = None,
+        session: BrowserSession | None = None,
+        limiter: AdaptiveRateLimiter | None = None
+) -> list[str]:
+    """
+    Searches once for all service technician ads, without a company name, and matches the company names
+    found to the companies. Only the first 100 result pages are read, so companies with ads beyond them are
+    missed. The sweep is repeated for every call, so all companies should be passed at once,
+    e.g. with scrape_chunks(..., chunk_size=len(companies)).
+    """
+    own_session = session is None
+    if own_session:
+        session = linkedin_session(email_address, pw, cookie_file=None, headless=False, block_resources=False)
+    if limiter is None:
+        limiter = AdaptiveRateLimiter(rate=1.0)
+
+    waited = 0.0
+    start = perf_counter()
+    try:
+        waited = limiter.acquire()
+        start = perf_counter()
+        driver = session.driver
+        driver.get("https://www.linkedin.com/jobs/")
+        company_list, pages = read_all_pages([], driver)
+        limiter.success()
+        session.record_query()
+        telemetry.record_query("linkedin_sweep", "", perf_counter() - start, waited, pages=pages,
+                               results=len(company_list))
+        if on_result is not None and companies:
+            for c, matched in match_companies(company_list, companies, other_key("linkedin sweep")).items():
+                on_result(c, matched)
+    except Exception as e:
+        print("Error with the sweep")
+        telemetry.record_query("linkedin_sweep", "", perf_counter() - start, waited, pages=0, error=type(e).__name__)
+        limiter.failure()
+        company_list = []
+    finally:
+        if own_session:
+            session.quit()
+    return company_list
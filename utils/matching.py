@@ -0,0 +1,91 @@
+import pandas as pd
+from utils.fuzzy_grouping import group_similar_names
+from utils.telemetry import telemetry
+
+
+def scraped_name_mapping(df_company_data: pd.DataFrame, df_xing: pd.DataFrame) -> dict[str, str]:
+    """
+    Maps the normalized names of the list of companies and of the scraped data to one key per company.
+    Scraped spellings within a Levenshtein distance of 1 of a listed company are mapped to it, every listed
+    company keeps its own name, so both sides can be joined on the mapped names.
+    """
+    company_names = df_company_data["lowercase_company"].dropna().unique().tolist()
+    scraped_names = df_xing["lowercase_company"].dropna().unique().tolist()
+    return group_similar_names(company_names + scraped_names, max_distance=1, preferred=company_names)[0]
+
+
+@telemetry.timed()
+def build_lead_table(
+        df_company_data: pd.DataFrame,
+        df_xing: pd.DataFrame,
+        current_customers: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Matches the list of companies with the scraped job ads and the current customers.
+
+    The number of ads is joined by the normalized company name ('lowercase_company') with a
+    hash lookup, after both sides are mapped to the same keys with scraped_name_mapping. Current customers are flagged with a hash-based anti-join on 'Company',
+    and "Ads per 100 employees" is computed once for all companies.
+
+    Parameters:
+    df_company_data (pd.DataFrame): Preprocessed list of companies.
+    df_xing (pd.DataFrame): Preprocessed scraped data with one row per 'lowercase_company' and its 'count'.
+    current_customers (pd.DataFrame): Current customers with a 'Company' column.
+
+    Returns:
+    pd.DataFrame: All companies with the columns "Service technician ads", "Ads per 100 employees" and "Is customer".
+    pd.DataFrame: Ranked leads, i.e. companies with ads that are not customers yet, sorted by "Ads per 100 employees".
+    """
+    df = df_company_data.copy()
+    mapping = scraped_name_mapping(df, df_xing)
+    ads_per_company = df_xing.groupby(df_xing["lowercase_company"].map(mapping))["count"].sum()
+    df["Service technician ads"] = df["lowercase_company"].map(mapping).map(ads_per_company).fillna(0).astype(int)
+    df["Ads per 100 employees"] = df["Service technician ads"] / df["Employees"] * 100
+    df["Is customer"] = df["Company"].isin(current_customers["Company"])
+
+    leads = df[(df["Service technician ads"] > 0) & ~df["Is customer"]]
+    leads = leads.sort_values(by="Ads per 100 employees", ascending=False, kind="stable").reset_index(drop=True)
+    return df, leads
+
+
+def additional_companies(df_xing: pd.DataFrame, df_company_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the scraped companies that are not in the list of companies
+    (anti-join on 'lowercase_company' after scraped_name_mapping).
+    """
+    mapping = scraped_name_mapping(df_company_data, df_xing)
+    return df_xing[~df_xing["lowercase_company"].map(mapping).isin(df_company_data["lowercase_company"])]
+
+
+SORT_KEYS = ["Ads per 100 employees", "Service technician ads", "Annual Revenue (USD)", "Employees"]
+
+
+class TopKIndex:
+    """
+    Top k companies of every cluster that are not customers yet, ranked by sort_by (all descending).
+
+    The index is built once after clustering with a single sort. Looking up a cluster is a dict lookup.
+    The first key of sort_by ranks the companies, and the following keys break ties.
+    """
+
+    def __init__(
+            self,
+            df_company_data: pd.DataFrame,
+            labels: pd.Series,
+            k: int = 10,
+            sort_by: list[str] = SORT_KEYS[:2]):
+        self.k = k
+        self.sort_by = list(sort_by)
+        candidates = df_company_data[~df_company_data["Is customer"]]
+        candidates = candidates.assign(**{"Cluster labels": labels.reindex(candidates.index)})
+        ranked = candidates.sort_values(by=self.sort_by, ascending=False, kind="stable")
+        top = ranked.groupby("Cluster labels").head(k)
+        self.clusters = {cluster: group for cluster, group in top.groupby("Cluster labels", sort=False)}
+        self._empty = top.iloc[:0]
+
+    def covers(self, k: int, sort_by: list[str]) -> bool:
+        """Whether lookups with k and sort_by can be answered by this index."""
+        return k <= self.k and list(sort_by) == self.sort_by
+
+    def lookup(self, cluster: int, k: int | None = None) -> pd.DataFrame:
+        """Returns the top k (default: all indexed) companies of cluster."""
+        return self.clusters.get(cluster, self._empty).head(k or self.k)
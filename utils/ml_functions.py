@@ -1,32 +1,286 @@
+import glob
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, silhouette_samples, silhouette_score
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import numpy as np
+from utils.telemetry import telemetry
 
-def kmeans_clustering(data: pd.DataFrame, n_clusters: int) -> pd.DataFrame:
+MODEL_DIR = "data/models"
+N_CLUSTERS_OPTIONS = [2, 3, 4, 5, 6]
+MINIBATCH_THRESHOLD = 50000  # Number of companies from which mode "auto" uses MiniBatchKMeans
+MAX_NEW_FRACTION = 0.2  # Share of new companies up to which an existing model is updated instead of refitted
+WEBGL_THRESHOLD = 5000  # Number of points from which plots use WebGL traces and precomputed statistics
+MAX_PLOT_POINTS = 20000  # Scatter plots show a stratified sample of this size for larger lists
+SILHOUETTE_SAMPLE_SIZE = 5000  # Silhouette scores are O(n²), so they are computed on a sample of this size
+MAX_BASE_CANDIDATES = 10  # Number of most recent saved models that are checked for an incremental update
+MAX_MODELS = 25  # Models kept in memory, the least recently used are dropped first
+MAX_SAVED_MODELS = 100  # Models kept in model_dir, the least recently used files are deleted first
+
+
+def row_hashes(data: pd.DataFrame) -> np.ndarray:
+    """Returns one hash per row of data, independent of the index."""
+    return pd.util.hash_pandas_object(data, index=False).to_numpy()
+
+
+class ClusterModelCache:
+    """
+    Cache of fitted (kmeans, scaler) pairs, keyed by the hash of the data, the clustering mode and n_clusters.
+
+    Models are kept in memory and saved to model_dir, so they survive restarts of the app. Only the max_models
+    most recently used models stay in memory and the max_saved_models most recently used files in model_dir.
+    Every model also stores the hashes of the rows it was fitted on. For data that only adds a few rows to the data of a cached
+    model, the cached model is reused: MiniBatchKMeans models are updated with the new rows, KMeans models
+    assign the new rows to the nearest existing cluster.
+    """
+
+    def __init__(self, model_dir: str | None = MODEL_DIR, max_models: int = MAX_MODELS,
+                 max_saved_models: int = MAX_SAVED_MODELS):
+        self.model_dir = model_dir
+        self.max_models = max_models
+        self.max_saved_models = max_saved_models
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key: tuple) -> str:
+        return os.path.join(self.model_dir, "{}_{}_{}.pkl".format(*key))
+
+    def _remember(self, key: tuple, model: tuple):
+        self._models[key] = model
+        self._models.move_to_end(key)
+        while len(self._models) > self.max_models:
+            self._models.popitem(last=False)
+
+    def _prune_files(self):
+        # The modification time of a file is its last use, see get
+        paths = sorted(glob.glob(os.path.join(self.model_dir, "*.pkl")), key=os.path.getmtime)
+        for path in paths[:-self.max_saved_models]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # Already removed by another process
+                pass
+
+    def _peek(self, key: tuple):
+        """Returns the model of key like get, but without counting it as used."""
+        with self._lock:
+            if key in self._models:
+                return self._models[key]
+        if self.model_dir is None:
+            return None
+        try:
+            return pd.read_pickle(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def get(self, key: tuple):
+        """Returns (kmeans, scaler, row_hashes) for key = (data hash, mode, n_clusters), or None."""
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            if self.model_dir is None:
+                return None
+            try:
+                model = pd.read_pickle(self._path(key))
+                os.utime(self._path(key))
+            except FileNotFoundError:
+                return None
+            self._remember(key, model)
+            return model
+
+    def put(self, key: tuple, kmeans, scaler, row_hashes: np.ndarray):
+        with self._lock:
+            self._remember(key, (kmeans, scaler, row_hashes))
+            if self.model_dir is not None:
+                os.makedirs(self.model_dir, exist_ok=True)
+                tmp_file = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+                pd.to_pickle(self._models[key], tmp_file)
+                os.replace(tmp_file, self._path(key))
+                self._prune_files()
+
+    def find_base(self, mode: str, n_clusters: int, row_hashes: np.ndarray):
+        """
+        Returns the cached model of the same mode and n_clusters whose rows are all contained in row_hashes
+        and that covers most of them, together with a mask of the rows that are new to it, or None.
+        """
+        with self._lock:
+            keys = {key for key in self._models if key[1:] == (mode, n_clusters)}
+        if self.model_dir is not None:
+            paths = sorted(glob.glob(os.path.join(self.model_dir, f"*_{mode}_{n_clusters}.pkl")), key=os.path.getmtime)
+            for path in paths[-MAX_BASE_CANDIDATES:]:
+                keys.add((os.path.basename(path).split("_")[0], mode, n_clusters))
+        # Candidates are only inspected, so only the chosen base counts as used in the memory and on disk
+        best = None
+        for key in keys:
+            model = self._peek(key)
+            if model is None:  # Deleted since, e.g. by another process
+                continue
+            base_hashes = model[2]
+            if len(base_hashes) > len(row_hashes):
+                continue
+            new = ~np.isin(row_hashes, base_hashes)
+            if np.isin(base_hashes, row_hashes).all() and (best is None or new.sum() < best[1].sum()):
+                best = (key, new)
+        if best is None:
+            return None
+        model = self.get(best[0])
+        if model is None:
+            return None
+        return (model[0], model[1]), best[1]
+
+
+model_cache = ClusterModelCache()
+
+
+def _new_model(mode: str, n_clusters: int, init="k-means++"):
+    # Given initial centers are used once, k-means++ is run several times as before
+    warm_start = not isinstance(init, str)
+    if mode == "minibatch":
+        return MiniBatchKMeans(n_clusters=n_clusters, random_state=42, init=init, batch_size=4096, n_init=1 if warm_start else 3)
+    return KMeans(n_clusters=n_clusters, random_state=42, init=init, n_init=1 if warm_start else "auto")
+
+
+@telemetry.timed()
+def kmeans_clustering(
+        data: pd.DataFrame,
+        n_clusters: int,
+        mode: str = "full",
+        cache: ClusterModelCache | None = None) -> pd.DataFrame:
     """
     Perform K-Means clustering on the given data.
 
     Parameters:
     data (DataFrame): The input data for clustering.
     n_clusters (int): The number of clusters to form.
+    mode (str): "full" for KMeans, "minibatch" for MiniBatchKMeans, or "auto" to use MiniBatchKMeans
+        for more than MINIBATCH_THRESHOLD rows.
+    cache (ClusterModelCache): If given, fitted models are reused for the same data and updated
+        for data with up to MAX_NEW_FRACTION new rows (see ClusterModelCache). With more new rows,
+        the model is refitted starting from the cached cluster centers.
 
     Returns:
     DataFrame: The input data with an additional column for cluster labels.
     """
-    scaler = StandardScaler()
-    data_scaled = scaler.fit_transform(data)
+    if mode == "auto":
+        mode = "minibatch" if len(data) > MINIBATCH_THRESHOLD else "full"
+    if cache is None:
+        scaler = StandardScaler()
+        kmeans = _new_model(mode, n_clusters)
+        kmeans.fit(scaler.fit_transform(data))
+    else:
+        hashes = row_hashes(data)
+        key = (hashlib.sha1(hashes).hexdigest(), mode, n_clusters)
+        cached = cache.get(key)
+        if cached is not None:
+            kmeans, scaler, _ = cached
+        else:
+            base = cache.find_base(mode, n_clusters, hashes)
+            if base is not None and base[1].mean() <= MAX_NEW_FRACTION:
+                (kmeans, scaler), new = base
+                if mode == "minibatch" and new.any():
+                    kmeans = deepcopy(kmeans)
+                    kmeans.partial_fit(scaler.transform(data[new]))
+            else:
+                scaler = StandardScaler()
+                data_scaled = scaler.fit_transform(data)
+                init = "k-means++"
+                if base is not None:
+                    # Warm start from the centers of the closest cached model
+                    (base_kmeans, base_scaler), _ = base
+                    centers = pd.DataFrame(base_scaler.inverse_transform(base_kmeans.cluster_centers_), columns=data.columns)
+                    init = scaler.transform(centers)
+                kmeans = _new_model(mode, n_clusters, init)
+                kmeans.fit(data_scaled)
+            cache.put(key, kmeans, scaler, hashes)
 
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
     data = data.copy()  # Avoid SettingWithCopyWarning
-    data['Cluster labels'] = kmeans.fit_predict(data_scaled)
+    data['Cluster labels'] = kmeans.predict(scaler.transform(data))
 
     return data, kmeans, scaler
 
 
+@telemetry.timed()
+def precompute_clusterings(
+        data: pd.DataFrame,
+        n_clusters_options: list[int] = N_CLUSTERS_OPTIONS,
+        mode: str = "full",
+        cache: ClusterModelCache | None = None,
+        n_jobs: int = len(N_CLUSTERS_OPTIONS)) -> dict:
+    """Runs kmeans_clustering for every number of clusters in parallel. Returns a dict n_clusters -> result."""
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        results = pool.map(lambda n_clusters: kmeans_clustering(data, n_clusters, mode, cache), n_clusters_options)
+        return dict(zip(n_clusters_options, results))
+
+
+def stratified_sample(labels: np.ndarray, sample_size: int, random_state: int = 42) -> np.ndarray:
+    """Returns the indices of a random sample with the same share of every cluster as labels."""
+    rng = np.random.default_rng(random_state)
+    clusters, counts = np.unique(labels, return_counts=True)
+    sizes = np.maximum(np.round(counts / counts.sum() * sample_size).astype(int), np.minimum(counts, 2))
+    return np.concatenate([
+        rng.choice(np.flatnonzero(labels == cluster), size=size, replace=False)
+        for cluster, size in zip(clusters, sizes)])
+
+
+def sampled_silhouette_score(
+        data_scaled: np.ndarray,
+        labels: np.ndarray,
+        sample_size: int = SILHOUETTE_SAMPLE_SIZE,
+        random_state: int = 42) -> tuple[float, float, float]:
+    """
+    Silhouette score on a stratified sample of at most sample_size points.
+
+    Returns:
+    float: Silhouette score.
+    float, float: Bounds of the 95% confidence interval, which are equal to the score if all points are used.
+    """
+    labels = np.asarray(labels)
+    if len(labels) <= sample_size:
+        score = silhouette_score(data_scaled, labels)
+        return score, score, score
+    sample = stratified_sample(labels, sample_size, random_state)
+    values = silhouette_samples(data_scaled[sample], labels[sample])
+    score = values.mean()
+    margin = 1.96 * values.std(ddof=1) / np.sqrt(len(values))
+    return score, score - margin, score + margin
+
+
+@telemetry.timed()
+def cluster_scores(clusterings: dict) -> pd.DataFrame:
+    """
+    Evaluates the results of precompute_clusterings for every number of clusters.
+
+    Calinski-Harabasz and Davies-Bouldin are computed on all points, the silhouette score on a sample
+    (see sampled_silhouette_score). All scores are computed in the scaled space the clustering works in.
+
+    Returns:
+    DataFrame: One row per number of clusters with the scores.
+    """
+    rows = []
+    for n_clusters, (df_clustered, kmeans, scaler) in clusterings.items():
+        data_scaled = scaler.transform(df_clustered.drop(columns="Cluster labels"))
+        labels = df_clustered["Cluster labels"].to_numpy()
+        silhouette, low, high = sampled_silhouette_score(data_scaled, labels)
+        rows.append({
+            "Number of clusters": n_clusters,
+            "Silhouette score": silhouette,
+            "Silhouette 95% CI low": low,
+            "Silhouette 95% CI high": high,
+            "Calinski-Harabasz": calinski_harabasz_score(data_scaled, labels),
+            "Davies-Bouldin": davies_bouldin_score(data_scaled, labels),
+        })
+    return pd.DataFrame(rows)
+
+
 def plot_clusters_3d(df: pd.DataFrame):
     """
     Plot the clusters in a 3D scatter plot.
@@ -71,6 +325,55 @@ def plot_clusters_3d(df: pd.DataFrame):
     )
     return fig
 
+def _clip(polygon: np.ndarray, normal: np.ndarray, offset: float) -> np.ndarray:
+    """Sutherland-Hodgman: clips a convex polygon to the half-plane normal·z <= offset."""
+    if len(polygon) == 0:
+        return polygon
+    distance = polygon @ normal - offset
+    clipped = []
+    for k in range(len(polygon)):
+        current, following = polygon[k], polygon[(k + 1) % len(polygon)]
+        d_current, d_following = distance[k], distance[(k + 1) % len(polygon)]
+        if d_current <= 0:
+            clipped.append(current)
+        if d_current * d_following < 0:
+            clipped.append(current + (following - current) * d_current / (d_current - d_following))
+    return np.array(clipped).reshape(-1, 2)
+
+
+_voronoi_cache = {}
+
+
+def voronoi_cells(kmeans, scaler, bounds: tuple[float, float, float, float]) -> list[np.ndarray]:
+    """
+    Returns the region of every cluster within bounds = (x_min, x_max, y_min, y_max) as a polygon in the
+    original units.
+
+    KMeans assigns a point to the nearest center in the scaled space, so every region is the bounding box
+    clipped by one half-plane per other center there. The scaler is affine, so the vertices can be
+    transformed back. Results are cached per model, as they only depend on the centers, the scaler and bounds.
+    """
+    centers = kmeans.cluster_centers_
+    key = (centers.tobytes(), scaler.mean_.tobytes(), scaler.scale_.tobytes(), tuple(bounds))
+    if key in _voronoi_cache:
+        return _voronoi_cache[key]
+    x_min, x_max, y_min, y_max = bounds
+    box = (np.array([[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max]]) - scaler.mean_) / scaler.scale_
+    cells = []
+    for i, center in enumerate(centers):
+        cell = box
+        for j, other in enumerate(centers):
+            if j != i:
+                # Points closer to center than to other
+                cell = _clip(cell, other - center, (other @ other - center @ center) / 2)
+        cells.append(cell * scaler.scale_ + scaler.mean_)
+    if len(_voronoi_cache) >= 64:
+        _voronoi_cache.clear()
+    _voronoi_cache[key] = cells
+    return cells
+
+
+@telemetry.timed()
 def plot_clusters_2d(df, kmeans, scaler, current_customers):
     """
     Plot the clusters in a 2D scatter plot.
@@ -85,14 +388,11 @@ def plot_clusters_2d(df, kmeans, scaler, current_customers):
     x_min, x_max = df["Annual Revenue (USD)"].min(), df["Annual Revenue (USD)"].max()
     y_min, y_max = df["Employees"].min(), df["Employees"].max()
 
-    # Grid for Decision Boundaries:
-    xx, yy = np.meshgrid(
-        np.linspace(x_min, x_max, 300),
-        np.linspace(y_min, y_max, 300)
-    )
-    mesh_data = np.c_[xx.ravel(), yy.ravel()]
-    mesh_data_scaled = scaler.transform(mesh_data)
-    Z = kmeans.predict(mesh_data_scaled).reshape(xx.shape)
+    # Large lists are drawn with WebGL and only a sample of the points is sent to the browser
+    n_companies = len(df)
+    if n_companies > MAX_PLOT_POINTS:
+        df = df.iloc[np.sort(stratified_sample(df["Cluster labels"].to_numpy(), MAX_PLOT_POINTS))]
+    scatter = go.Scattergl if n_companies > WEBGL_THRESHOLD else go.Scatter
 
     # Cluster colors in rgb format:
     cluster_colors = [
@@ -111,29 +411,35 @@ def plot_clusters_2d(df, kmeans, scaler, current_customers):
     #     [0.75, "rgb(204, 121, 167)"], # Cluster 3
     #     [1, "rgb(240, 228, 66)"]      # Cluster 4
     # ]
-   
 
     fig = go.Figure()
 
-    # Show the decision boundaries as background:
-    fig.add_trace(go.Contour(
-        x=np.linspace(x_min, x_max, 300),
-        y=np.linspace(y_min, y_max, 300),
-        z=Z,
-        showscale=False,
-        colorscale=colorscale[:n],
-        opacity=0.2,
-        contours=dict(showlines=False)
-    ))
+    # Show the decision boundaries as background, one polygon per cluster:
+    cells = voronoi_cells(kmeans, scaler, (x_min, x_max, y_min, y_max))
+    for i, cell in enumerate(cells):
+        if len(cell):
+            fig.add_trace(go.Scatter(
+                x=cell[:, 0],
+                y=cell[:, 1],
+                mode="lines",
+                fill="toself",
+                fillcolor=cluster_colors[i],
+                line=dict(width=0),
+                opacity=0.2,
+                hoverinfo="skip",
+                showlegend=False
+            ))
 
     # Clusterpunkte:
-    fig.add_trace(go.Scatter(
+    fig.add_trace(scatter(
         x=df["Annual Revenue (USD)"],
         y=df["Employees"],
         mode='markers',
         marker=dict(
             color=df["Cluster labels"],
             colorscale=colorscale,
+            cmin=0,
+            cmax=n - 1,
             size=5,
             opacity=0.7
         ),
@@ -158,49 +464,93 @@ def plot_clusters_2d(df, kmeans, scaler, current_customers):
         name='Current customers'
     ))
 
+    title = "2D Scatter Plot with Cluster Boundaries"
+    if len(df) < n_companies:
+        title += f" (sample of {len(df)} of {n_companies} companies)"
     fig.update_layout(
-        title="2D Scatter Plot with Cluster Boundaries",
+        title=title,
         xaxis_title="Annual Revenue (USD)",
         yaxis_title="Employees"
     )
     return fig
 
 
+def box_statistics(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    """
+    Returns the statistics of a box plot of column for every cluster: quartiles, mean and the whiskers,
+    which end at the most extreme values within 1.5 times the interquartile range.
+    """
+    grouped = df.groupby("Cluster labels", observed=True)[column]
+    stats = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    stats.columns = ["q1", "median", "q3"]
+    stats["mean"] = grouped.mean()
+    iqr = stats["q3"] - stats["q1"]
+    values = df[column]
+    lower = (stats["q1"] - 1.5 * iqr).reindex(df["Cluster labels"]).to_numpy()
+    upper = (stats["q3"] + 1.5 * iqr).reindex(df["Cluster labels"]).to_numpy()
+    stats["lowerfence"] = values.where(values >= lower).groupby(df["Cluster labels"], observed=True).min()
+    stats["upperfence"] = values.where(values <= upper).groupby(df["Cluster labels"], observed=True).max()
+    return stats
+
+
+@telemetry.timed()
 def violin_plots(df_non_outliers: pd.DataFrame):
+    """
+    Plot the distribution of annual revenue and employees for every cluster.
 
+    For more than WEBGL_THRESHOLD companies, box plots from precomputed statistics are shown instead of
+    violins with all points, so the size of the figure does not depend on the number of companies.
+    """
     # Subplot-Layout: 1 Reihe, 2 Spalten
     fig = make_subplots(
         rows=1, cols=2,
         subplot_titles=("Annual Revenue by Cluster", "Employees by Cluster")
     )
 
-    # Annual Revenue
-    fig.add_trace(
-        go.Violin(
-            x=df_non_outliers["Cluster labels"],
-            y=df_non_outliers["Annual Revenue (USD)"],
-            box_visible=True,
-            meanline_visible=True,
-            points="all",
-            marker=dict(size=2),
-            name="Annual Revenue"
-        ),
-        row=1, col=1
-    )
+    if len(df_non_outliers) > WEBGL_THRESHOLD:
+        for col, column in enumerate(["Annual Revenue (USD)", "Employees"], start=1):
+            stats = box_statistics(df_non_outliers, column)
+            fig.add_trace(
+                go.Box(
+                    x=stats.index,
+                    q1=stats["q1"],
+                    median=stats["median"],
+                    q3=stats["q3"],
+                    mean=stats["mean"],
+                    lowerfence=stats["lowerfence"],
+                    upperfence=stats["upperfence"],
+                    name="Annual Revenue" if col == 1 else column
+                ),
+                row=1, col=col
+            )
+    else:
+        # Annual Revenue
+        fig.add_trace(
+            go.Violin(
+                x=df_non_outliers["Cluster labels"],
+                y=df_non_outliers["Annual Revenue (USD)"],
+                box_visible=True,
+                meanline_visible=True,
+                points="all",
+                marker=dict(size=2),
+                name="Annual Revenue"
+            ),
+            row=1, col=1
+        )
 
-    # Employees
-    fig.add_trace(
-        go.Violin(
-            x=df_non_outliers["Cluster labels"],
-            y=df_non_outliers["Employees"],
-            box_visible=True,
-            meanline_visible=True,
-            points="all",
-            marker=dict(size=2),
-            name="Employees"
-        ),
-        row=1, col=2
-    )
+        # Employees
+        fig.add_trace(
+            go.Violin(
+                x=df_non_outliers["Cluster labels"],
+                y=df_non_outliers["Employees"],
+                box_visible=True,
+                meanline_visible=True,
+                points="all",
+                marker=dict(size=2),
+                name="Employees"
+            ),
+            row=1, col=2
+        )
 
     # Layout-Anpassungen
     fig.update_layout(
@@ -209,4 +559,34 @@ def violin_plots(df_non_outliers: pd.DataFrame):
         title_text="Distribution of Features by Cluster"
     )
 
-    return fig
\ No newline at end of file
+    return fig
+
+
+@telemetry.timed()
+def industry_histogram(company_data_selection: pd.DataFrame, current_customers: pd.DataFrame):
+    """
+    Plot the distribution of industries among the selected companies and the current customers.
+    """
+    df_joined = pd.concat([
+        company_data_selection[["Company", "Annual Revenue (USD)", "Employees", "Industry"]],
+        current_customers[["Company", "Annual Revenue (USD)", "Employees", "Industry"]]
+        ], ignore_index=True)
+    df_joined["Current customer"] = ["No"] * len(company_data_selection) + ["Yes"] * len(current_customers)
+
+    # Count in pandas, so only one bar per industry and group is sent to the browser
+    counts = (df_joined.astype({"Industry": object})
+              .groupby(["Industry", "Current customer"]).size().reset_index(name="count"))
+    fig = px.bar(counts, x="Industry", y="count", color="Current customer", title="Industry Distribution").update_xaxes(categoryorder="total descending")
+    return fig
+
+
+@telemetry.timed()
+def top_ads_bar(company_data_selection: pd.DataFrame):
+    """
+    Plot the ten companies with the most service technician ads.
+    """
+    top_ten = company_data_selection.sort_values(by="Service technician ads", ascending=False).head(10)
+    fig = px.bar(x=top_ten["Company"], y=top_ten["Service technician ads"],
+                 title="Top 10 companies with most service technician ads")
+    fig.update_layout(xaxis_title="Company", yaxis_title="Number of service technician ads")
+    return fig
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+LEGAL_SUFFIXES = (
+    r'\s(g?mbh|gmbh \&?\+? co kg|gmbh \&?\+? co. kg|se \&?\+? co. kg|ag|kg|ug|e.k.|e.v.|ohg|gbr|partg|partg mbb|kgaa|se|sce|ggmbh|gug|gag|gkg|eg|kgaa|gbr|llc|ltd.|ltd|inc.|inc|corp.|corp|plc|co. ltd.|co. kg|co kg|co.)*$')
+TRAILING_CONNECTORS = r'\&|\+\s?$'
+MAPPING_PATH = "data/company_names.json"
+MAX_NAMES = 200000  # Names kept in the mapping, the oldest are dropped first
+
+
+class CompanyNameNormalizer:
+    """
+    Normalizes company names: lowercase, without legal suffixes like "GmbH" or "Ltd".
+
+    The patterns are compiled once and every unique name is normalized only once. Series are
+    factorized, so the cost depends on the number of unique names and not on the number of rows.
+    The normalized names are kept in a mapping that can be saved to mapping_file and is shared
+    by the company list and the scraped data. The mapping is discarded if the patterns change.
+    It keeps at most max_names names, so the file doesn't grow without bound.
+    The normalizer is thread-safe, as it is shared by the app and the scrapers.
+    """
+
+    def __init__(self, mapping_file: str | None = MAPPING_PATH, max_names: int = MAX_NAMES):
+        self.mapping_file = mapping_file
+        self.max_names = max_names
+        self.version = hashlib.sha1((LEGAL_SUFFIXES + TRAILING_CONNECTORS).encode()).hexdigest()
+        self._suffixes = re.compile(LEGAL_SUFFIXES)
+        self._connectors = re.compile(TRAILING_CONNECTORS)
+        self._mapping = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    @property
+    def mapping(self) -> dict[str, str]:
+        if self._mapping is None:
+            with self._lock:
+                if self._mapping is None:
+                    self._mapping = self._load()
+        return self._mapping
+
+    def _load(self) -> dict[str, str]:
+        if self.mapping_file is None or not os.path.exists(self.mapping_file):
+            return {}
+        with open(self.mapping_file) as f:
+            stored = json.load(f)
+        if stored.get("version") != self.version:
+            return {}
+        return stored["names"]
+
+    def save(self):
+        """Saves the mapping if new names have been normalized since it was loaded."""
+        if self.mapping_file is None or not self._dirty:
+            return
+        mapping = self.mapping
+        with self._save_lock:
+            # Names normalized by other threads while writing are saved the next time
+            with self._lock:
+                names = dict(mapping)
+                self._dirty = False
+            os.makedirs(os.path.dirname(self.mapping_file) or ".", exist_ok=True)
+            tmp_file = f"{self.mapping_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"version": self.version, "names": names}, f)
+            os.replace(tmp_file, self.mapping_file)
+
+    def _normalize(self, name: str) -> str:
+        name = name.lower()
+        name = self._suffixes.sub('', name)
+        name = self._connectors.sub('', name)
+        return name.replace("˚", "grad")
+
+    def normalize(self, name):
+        """Returns the normalized name, or NaN if name is not a string."""
+        if not isinstance(name, str):
+            return np.nan
+        mapping = self.mapping
+        normalized = mapping.get(name)
+        if normalized is None:
+            normalized = self._normalize(name)
+            with self._lock:
+                mapping[name] = normalized
+                while len(mapping) > self.max_names:
+                    del mapping[next(iter(mapping))]
+                self._dirty = True
+        return normalized
+
+    def normalize_series(self, names: pd.Series) -> pd.Series:
+        """Normalizes every unique name of the Series once and maps the results back to the rows."""
+        codes, uniques = pd.factorize(names)
+        normalized = np.array([self.normalize(name) for name in uniques], dtype=object)
+        # Missing values (code -1) are kept as they are
+        values = np.where(codes >= 0, normalized[codes] if len(normalized) else None, names.to_numpy(dtype=object))
+        return pd.Series(values, index=names.index, name=names.name)
+
+
+normalizer = CompanyNameNormalizer()
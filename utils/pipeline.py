@@ -0,0 +1,232 @@
+"""
+Batch pipeline that runs the whole flow of the app without Streamlit, e.g. as a scheduled job overnight.
+
+Usage:
+    python -m utils.pipeline data/company_data/<file>.xlsx [--from-stage STAGE | --stage STAGE]
+
+The results of every stage are written to data/pipeline/<file>/. The app loads these
+precomputed results instead of recomputing them as long as the input files are unchanged.
+"""
+import argparse
+import json
+import os
+import pandas as pd
+from utils import dataset_catalog
+from utils.data_cleaning import preprocess_company_list, preprocess_scraped_data
+from utils.matching import TopKIndex, build_lead_table, additional_companies
+from utils.ml_functions import N_CLUSTERS_OPTIONS, cluster_scores, model_cache, precompute_clusterings
+from utils.telemetry import telemetry
+
+STAGES = ["load", "preprocess", "scrape", "match", "cluster", "rank"]
+# Stages before the scrape don't depend on the scraped data, which the scrape stage (re)writes
+SCRAPED_DATA_STAGES = STAGES[STAGES.index("scrape"):]
+CUSTOMERS_PATH = "data/customers/Active_Accounts_with_revenue.xlsx"
+PIPELINE_DIR = "data/pipeline"
+
+
+def scraped_path_for(company_file: str) -> str:
+    return f"data/scraped_data/xing_data_{os.path.basename(company_file)}"
+
+
+def output_dir_for(company_file: str) -> str:
+    return os.path.join(PIPELINE_DIR, os.path.splitext(os.path.basename(company_file))[0])
+
+
+def _input_signature(paths: list[str]) -> dict[str, float]:
+    return {path: os.path.getmtime(path) for path in paths if os.path.exists(path)}
+
+
+def _stage_inputs(stage: str, company_file: str, customers_file: str) -> dict[str, float]:
+    """Signature of the input files the results of stage depend on, directly or through earlier stages."""
+    paths = [company_file, customers_file]
+    if stage in SCRAPED_DATA_STAGES:
+        paths.append(scraped_path_for(company_file))
+    return _input_signature(paths)
+
+
+class BatchPipeline:
+    """
+    Runs the stages load, preprocess, scrape, match, cluster and rank for one list of companies.
+
+    Every stage reads the artifacts of the previous stages from output_dir and writes its own,
+    so a single stage can be run again or the pipeline can be started from a chosen stage.
+    """
+
+    def __init__(
+            self,
+            company_file: str,
+            customers_file: str = CUSTOMERS_PATH,
+            output_dir: str | None = None,
+            scrape: bool = True,
+            scraping_mode: str = "browser",
+            batched: bool = False,
+            n_workers: int = 1,
+            ttl: pd.Timedelta | None = pd.Timedelta(days=7),
+            top_k: int = 10,
+            cluster_mode: str = "auto"):
+        self.company_file = company_file
+        self.customers_file = customers_file
+        self.output_dir = output_dir or output_dir_for(company_file)
+        self.scraped_path = scraped_path_for(company_file)
+        self.scrape_enabled = scrape
+        self.scraping_mode = scraping_mode
+        self.batched = batched
+        self.n_workers = n_workers
+        self.ttl = ttl
+        self.top_k = top_k
+        self.cluster_mode = cluster_mode
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.output_dir, f"{name}.pkl")
+
+    def _save(self, name: str, obj):
+        pd.to_pickle(obj, self._path(name))
+
+    def _load(self, name: str):
+        return pd.read_pickle(self._path(name))
+
+    def _update_manifest(self, stage: str):
+        manifest_path = os.path.join(self.output_dir, "manifest.json")
+        manifest = {"stages": {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        manifest.pop("inputs", None)  # Written by older versions for all stages at once
+        # Results of later stages were computed from the results this stage has just replaced
+        for later_stage in STAGES[STAGES.index(stage) + 1:]:
+            manifest["stages"].pop(later_stage, None)
+        manifest["stages"][stage] = {
+            "finished_at": pd.Timestamp.now().isoformat(),
+            "inputs": _stage_inputs(stage, self.company_file, self.customers_file),
+        }
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def load(self):
+        self._save("companies_raw", dataset_catalog.load(self.company_file, "company_data"))
+        self._save("customers", dataset_catalog.load(self.customers_file, "customers"))
+
+    def preprocess(self):
+        self._save("companies", preprocess_company_list(self._load("companies_raw"), self._load("customers")))
+
+    def scrape(self):
+        if self.scrape_enabled:
+            from utils.data_chunks import scrape_chunks
+            from utils.xing_scraper import scraper, http_scraper, batch_scraper, http_batch_scraper, http_limiter, xing_session
+            source = "xing_batched" if self.batched else "xing"
+            if self.scraping_mode == "http":
+                scrape_chunks(self._load("companies"), http_batch_scraper if self.batched else http_scraper,
+                              self.scraped_path, 100, n_workers=self.n_workers, source=source, ttl=self.ttl,
+                              limiter=http_limiter())
+            else:
+                scrape_chunks(self._load("companies"), batch_scraper if self.batched else scraper,
+                              self.scraped_path, 100, n_workers=self.n_workers, session_factory=xing_session,
+                              source=source, ttl=self.ttl)
+        df_scraped_raw = dataset_catalog.load(self.scraped_path, "scraped_data")
+        # preprocess_scraped_data adds the cleaned names to df_scraped_raw, which is needed for the additional companies
+        df_scraped = preprocess_scraped_data(df_scraped_raw, self._load("customers"))
+        self._save("scraped_raw", df_scraped_raw)
+        self._save("scraped", df_scraped)
+
+    def match(self):
+        companies, leads = build_lead_table(self._load("companies"), self._load("scraped"), self._load("customers"))
+        self._save("companies_matched", companies)
+        self._save("leads", leads)
+        self._save("additional_companies", additional_companies(self._load("scraped_raw"), companies))
+        leads.to_excel(os.path.join(self.output_dir, "leads.xlsx"), index=False)
+
+    def cluster(self):
+        companies = self._load("companies_matched")
+        X = companies[["Annual Revenue (USD)", "Employees"]]
+        assignments = companies[["Company"]].copy()
+        clusterings = precompute_clusterings(X, mode=self.cluster_mode, cache=model_cache)
+        for n_clusters, (df_clustered, kmeans, scaler) in clusterings.items():
+            self._save(f"clusters_{n_clusters}", (df_clustered, kmeans, scaler))
+            assignments[f"Cluster ({n_clusters} clusters)"] = df_clustered["Cluster labels"]
+        assignments.to_excel(os.path.join(self.output_dir, "cluster_assignments.xlsx"), index=False)
+        self._save("cluster_scores", cluster_scores(clusterings))
+
+    def rank(self):
+        companies = self._load("companies_matched")
+        for n_clusters in N_CLUSTERS_OPTIONS:
+            df_clustered = self._load(f"clusters_{n_clusters}")[0]
+            self._save(f"top_k_index_{n_clusters}", TopKIndex(companies, df_clustered["Cluster labels"], self.top_k))
+
+    def run(self, stages: list[str]):
+        os.makedirs(self.output_dir, exist_ok=True)
+        telemetry.start_run()
+        try:
+            for stage in stages:
+                print(f"Running stage '{stage}'")
+                with telemetry.span(f"pipeline.{stage}", company_file=self.company_file):
+                    getattr(self, stage)()
+                self._update_manifest(stage)
+        finally:
+            telemetry.flush()
+        print(telemetry.breakdown().to_string(index=False, float_format="{:.3f}".format))
+
+
+def load_artifacts(company_file: str, customers_file: str = CUSTOMERS_PATH, output_dir: str | None = None) -> dict | None:
+    """
+    Returns the precomputed results of the pipeline for company_file, or None if the pipeline has not
+    been run completely or an input file has changed since any of its stages ran.
+    """
+    output_dir = output_dir or output_dir_for(company_file)
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    for stage in STAGES:
+        entry = manifest["stages"].get(stage)
+        if not isinstance(entry, dict) or entry["inputs"] != _stage_inputs(stage, company_file, customers_file):
+            return None
+    names = ["customers", "companies_matched", "scraped", "leads", "additional_companies", "cluster_scores"]
+    for n_clusters in N_CLUSTERS_OPTIONS:
+        names += [f"clusters_{n_clusters}", f"top_k_index_{n_clusters}"]
+    paths = {name: os.path.join(output_dir, f"{name}.pkl") for name in names}
+    # Results of an older version of the pipeline may lack some artifacts
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+    artifacts = {"finished_at": manifest["stages"]["rank"]["finished_at"]}
+    for name, path in paths.items():
+        artifacts[name] = pd.read_pickle(path)
+    return artifacts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the find(IQ) lead pipeline without the Streamlit app.")
+    parser.add_argument("company_file", help="Excel list of companies, e.g. data/company_data/company_data_<timestamp>.xlsx")
+    parser.add_argument("--customers", default=CUSTOMERS_PATH, help="Excel file with the current customers")
+    parser.add_argument("--output-dir", help="Directory for the results (default: data/pipeline/<company file>)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--stage", choices=STAGES, help="Run only this stage")
+    group.add_argument("--from-stage", choices=STAGES, default=STAGES[0], help="Run this and all following stages")
+    parser.add_argument("--no-scraping", action="store_true", help="Use the existing scraped data instead of scraping")
+    parser.add_argument("--scraping-mode", choices=["browser", "http"], default="browser")
+    parser.add_argument("--batched", action="store_true", help="Search for several companies at once with OR queries")
+    parser.add_argument("--n-workers", type=int, default=1, help="Number of parallel browsers")
+    parser.add_argument("--ttl-days", type=float, default=7, help="Scrape companies again if their results are older")
+    parser.add_argument("--top-k", type=int, default=10, help="Number of top companies per cluster")
+    parser.add_argument("--cluster-mode", choices=["auto", "full", "minibatch"], default="auto",
+                        help="KMeans, MiniBatchKMeans, or MiniBatchKMeans only for large lists")
+    args = parser.parse_args()
+
+    pipeline = BatchPipeline(
+        args.company_file,
+        customers_file=args.customers,
+        output_dir=args.output_dir,
+        scrape=not args.no_scraping,
+        scraping_mode=args.scraping_mode,
+        batched=args.batched,
+        n_workers=args.n_workers,
+        ttl=pd.Timedelta(days=args.ttl_days),
+        top_k=args.top_k,
+        cluster_mode=args.cluster_mode)
+    stages = [args.stage] if args.stage else STAGES[STAGES.index(args.from_stage):]
+    pipeline.run(stages)
+    print(f"Results saved to {pipeline.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
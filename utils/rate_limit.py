@@ -0,0 +1,65 @@
+import threading
+from collections import deque
+from time import monotonic, sleep
+
+MAX_WAITS = 10000
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket that paces the queries of the scrapers.
+
+    Tokens are refilled with the current rate (queries per second). The rate is
+    increased a little after every healthy response and halved after an error or
+    throttling, but it always stays between min_rate and max_rate. The waiting time
+    used for the last MAX_WAITS queries is recorded in waits as (query, seconds).
+    The limiter is thread-safe, so several workers can share one.
+    """
+
+    def __init__(
+            self,
+            rate: float = 2.0,
+            min_rate: float = 0.2,
+            max_rate: float = 10.0,
+            burst: int = 1,
+            increase: float = 0.1,
+            decrease: float = 0.5):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.waits = deque(maxlen=MAX_WAITS)
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, query: str = "") -> float:
+        """Blocks until a token is available and returns the time waited in seconds."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.waits.append((query, waited))
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+    def success(self):
+        """Speeds up after a healthy response."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def failure(self):
+        """Backs off after an error or throttling."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
@@ -0,0 +1,94 @@
+import sqlite3
+import threading
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+import pandas as pd
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def cache_key(company: str) -> str:
+    """Normalizes a company name for lookups in the store."""
+    return " ".join(str(company).lower().split())
+
+
+class ScrapeStore:
+    """
+    Append-only SQLite store and cache for scraping results.
+
+    Every searched company is recorded as soon as its search is finished, together with
+    the number of job ads, the company names found in them and a timestamp. Entries are
+    keyed by source (e.g. "xing") and the normalized company name, so one store can be
+    shared by all lists of companies. Companies scraped within a TTL don't need to be
+    scraped again, and an interrupted scrape can be resumed from the last completed company.
+    """
+
+    def __init__(self, path: str, source: str = "xing"):
+        self.path = path
+        self.source = source
+        self._lock = threading.Lock()
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "source TEXT NOT NULL, key TEXT NOT NULL, query TEXT NOT NULL, "
+                "scraped_at TEXT NOT NULL, n_results INTEGER NOT NULL, PRIMARY KEY (source, key))")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "source TEXT NOT NULL, key TEXT NOT NULL, company TEXT NOT NULL)")
+            con.execute("CREATE INDEX IF NOT EXISTS results_key ON results (source, key)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:  # commits on success, rolls back on error
+                yield con
+        finally:
+            con.close()
+
+    def append(self, query: str, companies: list[str]):
+        """
+        Records the companies found when searching for query, replacing an older result of the same query.
+        All writes happen in one transaction, so a query is either stored completely or not at all.
+        """
+        key = cache_key(query)
+        with self._lock, self._connect() as con:
+            con.execute("DELETE FROM results WHERE source = ? AND key = ?", (self.source, key))
+            con.executemany(
+                "INSERT INTO results (source, key, company) VALUES (?, ?, ?)",
+                [(self.source, key, c) for c in companies])
+            con.execute(
+                "INSERT OR REPLACE INTO queries (source, key, query, scraped_at, n_results) VALUES (?, ?, ?, ?, ?)",
+                (self.source, key, query, pd.Timestamp.now().strftime(TIMESTAMP_FORMAT), len(companies)))
+
+    def scraped_at(self) -> dict[str, pd.Timestamp]:
+        """Returns the time of the latest search for every normalized company name."""
+        with self._connect() as con:
+            rows = con.execute("SELECT key, scraped_at FROM queries WHERE source = ?", (self.source,)).fetchall()
+        return {key: pd.Timestamp(t) for key, t in rows}
+
+    def missing(self, companies: Iterable[str], ttl: pd.Timedelta | None = None) -> list[str]:
+        """
+        Returns the companies that have not been scraped yet or whose result is older than ttl.
+        If ttl is None, results never expire.
+        """
+        scraped_at = self.scraped_at()
+        cutoff = pd.Timestamp.now() - ttl if ttl is not None else pd.Timestamp.min
+        return [c for c in companies if scraped_at.get(cache_key(c), pd.Timestamp.min) <= cutoff]
+
+    def counts(self, companies: Iterable[str] | None = None) -> pd.DataFrame:
+        """
+        Returns the number of job ads per company found when searching for the given companies
+        (all stored companies if None), in the same format as value_counts() of the scraped company names.
+        """
+        with self._connect() as con:
+            df = pd.read_sql_query("SELECT key, company FROM results WHERE source = ?", con, params=(self.source,))
+        if companies is not None:
+            df = df[df["key"].isin({cache_key(c) for c in companies})]
+        df = df["company"].value_counts().sort_index().rename_axis("Company").reset_index()
+        return df
+
+    def export_excel(self, path: str, companies: Iterable[str] | None = None):
+        """Writes the counts to an Excel file."""
+        self.counts(companies).to_excel(path, index=False)
@@ -0,0 +1,212 @@
+"""
+Background scrape jobs, so the app stays responsive while a list of companies is scraped.
+
+Jobs are recorded in a small SQLite table next to the result cache and run one after another on a
+background thread of the app's server process. They keep running when the page is refreshed or
+closed, and every user of the app sees the same jobs. Submitting a list that is already queued or
+being scraped with the same settings returns the existing job instead of starting a second scrape.
+The results arrive in the result cache company by company, so partial results can be shown while
+a job is running and an interrupted job continues where it stopped when it is submitted again.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import pandas as pd
+from utils.data_chunks import CACHE_PATH, scrape_chunks
+from utils.result_store import TIMESTAMP_FORMAT, ScrapeStore
+
+JOBS_PATH = "data/scraped_data/scrape_jobs.sqlite"
+MODES = ["Browser", "HTTP", "Browser (batched)", "HTTP (batched)"]
+ACTIVE = ("queued", "running")
+CHUNK_SIZE = 100
+
+
+def source_for(mode: str) -> str:
+    """Name of the result cache source of a scraping mode. Batched results are kept apart."""
+    return "xing_batched" if mode.endswith("(batched)") else "xing"
+
+
+def run_scrape(
+        companies: list[str],
+        path: str,
+        mode: str,
+        n_workers: int = 1,
+        ttl: pd.Timedelta | None = pd.Timedelta(days=7),
+        cache_path: str = CACHE_PATH,
+        on_progress: Callable[[int, int], None] | None = None):
+    """Scrapes the companies from Xing with the given mode of MODES and writes the counts to path."""
+    from utils.xing_scraper import scraper, http_scraper, batch_scraper, http_batch_scraper, http_limiter, xing_session
+    batched = mode.endswith("(batched)")
+    df = pd.DataFrame({"Company": companies})
+    if mode.startswith("HTTP"):
+        scrape_chunks(df, http_batch_scraper if batched else http_scraper, path, CHUNK_SIZE, n_workers=n_workers,
+                      source=source_for(mode), ttl=ttl, cache_path=cache_path, on_progress=on_progress,
+                      limiter=http_limiter())
+    else:
+        scrape_chunks(df, batch_scraper if batched else scraper, path, CHUNK_SIZE, n_workers=n_workers,
+                      session_factory=xing_session, source=source_for(mode), ttl=ttl, cache_path=cache_path,
+                      on_progress=on_progress)
+
+
+def job_key(companies: list[str], path: str, mode: str) -> str:
+    """Identifies the scrape of a list of companies, independent of their order."""
+    sha1 = hashlib.sha1()
+    for value in [path, mode, *sorted(companies)]:
+        sha1.update(value.encode() + b"\0")
+    return sha1.hexdigest()
+
+
+class ScrapeJobQueue:
+    """
+    Queue of scrape jobs with their status and progress in a SQLite table.
+
+    Jobs run on a single background thread, each one with n_workers browsers as in scrape_chunks.
+    Jobs that were queued or running when the process stopped are marked as interrupted on first use.
+    """
+
+    def __init__(self, path: str = JOBS_PATH, cache_path: str = CACHE_PATH, run=run_scrape):
+        self.path = path
+        self.cache_path = cache_path
+        self.run = run
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scrape-job")
+        self._lock = threading.Lock()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        con = sqlite3.connect(self.path, timeout=30)
+        con.row_factory = sqlite3.Row
+        try:
+            with con:  # commits on success, rolls back on error
+                with self._init_lock:
+                    if not self._initialized:
+                        self._initialize(con)
+                yield con
+        finally:
+            con.close()
+
+    def _initialize(self, con: sqlite3.Connection):
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, status TEXT NOT NULL, "
+            "path TEXT NOT NULL, mode TEXT NOT NULL, n_workers INTEGER NOT NULL, ttl_days REAL, "
+            "companies TEXT NOT NULL, total INTEGER NOT NULL, cached INTEGER NOT NULL DEFAULT 0, "
+            "done INTEGER NOT NULL DEFAULT 0, submitted_at TEXT NOT NULL, started_at TEXT, finished_at TEXT, error TEXT)")
+        con.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)")
+        # No job of an earlier process can still be running
+        con.execute(f"UPDATE jobs SET status = 'interrupted' WHERE status IN {ACTIVE}")
+        self._initialized = True
+
+    def _update(self, job_id: int, **values):
+        with self._connect() as con:
+            con.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in values)} WHERE id = ?",
+                        (*values.values(), job_id))
+
+    def submit(
+            self,
+            companies: list[str],
+            path: str,
+            mode: str = "Browser",
+            n_workers: int = 1,
+            ttl: pd.Timedelta | None = pd.Timedelta(days=7)) -> int:
+        """
+        Queues the scrape of the companies and returns the id of the job.
+        If the same list is already queued or running with the same output file and mode, its id is returned.
+        """
+        key = job_key(companies, path, mode)
+        with self._lock:
+            with self._connect() as con:
+                row = con.execute(f"SELECT id FROM jobs WHERE key = ? AND status IN {ACTIVE}", (key,)).fetchone()
+                if row is not None:
+                    return row["id"]
+                job_id = con.execute(
+                    "INSERT INTO jobs (key, status, path, mode, n_workers, ttl_days, companies, total, submitted_at) "
+                    "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+                    (key, path, mode, n_workers, ttl / pd.Timedelta(days=1) if ttl is not None else None,
+                     json.dumps(companies), len(companies), pd.Timestamp.now().strftime(TIMESTAMP_FORMAT))).lastrowid
+            self._pool.submit(self._run, job_id)
+        return job_id
+
+    def _run(self, job_id: int):
+        # Any error has to mark the job as failed, otherwise it stays queued and blocks new scrapes of the list
+        try:
+            job = self.status(job_id)
+            companies = self.companies(job_id)
+            ttl = pd.Timedelta(days=job["ttl_days"]) if job["ttl_days"] is not None else None
+            n_missing = len(ScrapeStore(self.cache_path, source_for(job["mode"])).missing(companies, ttl))
+            # Progress counts all companies, those served from the cache are done from the start
+            n_cached = len(companies) - n_missing
+            self._update(job_id, status="running", cached=n_cached, done=n_cached,
+                         started_at=pd.Timestamp.now().strftime(TIMESTAMP_FORMAT))
+
+            def on_progress(done: int, total: int):
+                self._update(job_id, done=n_cached + done)
+
+            self.run(companies, job["path"], job["mode"], job["n_workers"], ttl, self.cache_path, on_progress)
+            self._update(job_id, status="done", finished_at=pd.Timestamp.now().strftime(TIMESTAMP_FORMAT))
+        except Exception as e:
+            print(f"Scrape job {job_id} failed: {e}")
+            try:
+                self._update(job_id, status="failed", error=f"{type(e).__name__}: {e}",
+                             finished_at=pd.Timestamp.now().strftime(TIMESTAMP_FORMAT))
+            except Exception as e:
+                print(f"Could not mark scrape job {job_id} as failed: {e}")
+
+    def status(self, job_id: int) -> dict | None:
+        """
+        Returns the job with its status ("queued", "running", "done", "failed" or "interrupted"),
+        the number of companies done and in total, and the estimated seconds left while it is running.
+        """
+        with self._connect() as con:
+            row = con.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {k: row[k] for k in row.keys() if k != "companies"}
+        job["eta"] = None
+        if job["status"] == "running":
+            # Extrapolated from the companies scraped since the start, excluding those from the cache
+            elapsed = (pd.Timestamp.now() - pd.Timestamp(job["started_at"])).total_seconds()
+            scraped = job["done"] - job["cached"]
+            if scraped > 0:
+                job["eta"] = elapsed / scraped * (job["total"] - job["done"])
+        return job
+
+    def companies(self, job_id: int) -> list[str]:
+        with self._connect() as con:
+            return json.loads(con.execute("SELECT companies FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+
+    def active_job(self, companies: list[str], path: str, mode: str) -> dict | None:
+        """Returns the queued or running job of the list, e.g. one started by another user, or None."""
+        with self._connect() as con:
+            row = con.execute(f"SELECT id FROM jobs WHERE key = ? AND status IN {ACTIVE} ORDER BY id DESC",
+                              (job_key(companies, path, mode),)).fetchone()
+        return self.status(row["id"]) if row is not None else None
+
+    def last_job(self, companies: list[str], path: str) -> dict | None:
+        """Returns the latest job of the list in any mode and status, or None if it was never scraped as a job."""
+        keys = [job_key(companies, path, mode) for mode in MODES]
+        with self._connect() as con:
+            row = con.execute(f"SELECT id FROM jobs WHERE key IN ({', '.join('?' * len(keys))}) ORDER BY id DESC",
+                              keys).fetchone()
+        return self.status(row["id"]) if row is not None else None
+
+    def jobs(self, limit: int = 20) -> pd.DataFrame:
+        """Returns the latest jobs without their lists of companies."""
+        with self._connect() as con:
+            return pd.read_sql_query(
+                "SELECT id, status, path, mode, done, total, submitted_at, started_at, finished_at, error "
+                "FROM jobs ORDER BY id DESC LIMIT ?", con, params=(limit,))
+
+    def partial_results(self, job_id: int) -> pd.DataFrame:
+        """Returns the number of ads per company found so far by the job, as in the scraped data."""
+        job = self.status(job_id)
+        return ScrapeStore(self.cache_path, source_for(job["mode"])).counts(self.companies(job_id))
+
+
+job_queue = ScrapeJobQueue()
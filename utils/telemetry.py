@@ -0,0 +1,215 @@
+"""
+Instrumentation of the processing stages and the scrapers.
+
+Spans measure how long a stage takes, scraper metrics record every query of a company. Both are appended
+to JSON lines files in TELEMETRY_DIR as they happen, and flush() writes the aggregated numbers to a
+Prometheus textfile (metrics.prom), which can be picked up by the textfile collector of node_exporter.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import pandas as pd
+
+TELEMETRY_DIR = "data/telemetry"
+MAX_RECORDS = 10000  # Number of spans and queries kept in memory for breakdown()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Telemetry:
+    """
+    Records spans and scraper queries in memory, in JSON lines files and as Prometheus metrics.
+
+    Every run of the app or the pipeline gets a run id with start_run(), so breakdown() can show the
+    stages of a single run. Spans are nested per thread, every span records the name of its parent.
+    """
+
+    def __init__(self, directory: str | None = TELEMETRY_DIR, max_records: int = MAX_RECORDS):
+        self.directory = directory
+        self.spans = deque(maxlen=max_records)
+        self.queries = deque(maxlen=max_records)
+        self._stage_totals = defaultdict(lambda: [0, 0.0])
+        self._query_totals = defaultdict(lambda: defaultdict(float))
+        self._last_run = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def run_id(self) -> str | None:
+        # Threads started by a run, e.g. thread pools, belong to the last run started
+        return getattr(self._local, "run_id", None) or self._last_run
+
+    def start_run(self) -> str:
+        """Starts a new run in the current thread and returns its id."""
+        self._local.run_id = self._last_run = uuid.uuid4().hex[:12]
+        return self._local.run_id
+
+    def _append(self, filename: str, record: dict):
+        if self.directory is None:
+            return
+        try:
+            with self._lock:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(os.path.join(self.directory, filename), "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+        except OSError as e:
+            print(f"Telemetry could not be written: {e}")
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Measures the time of the enclosed block as a span with the given name and attributes."""
+        stack = self._local.__dict__.setdefault("stack", [])
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start = time.time()
+        start_counter = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start_counter
+            stack.pop()
+            record = {"run": self.run_id, "name": name, "parent": parent, "start": start,
+                      "seconds": seconds, "error": error, **attributes}
+            with self._lock:
+                self.spans.append(record)
+                self._stage_totals[name][0] += 1
+                self._stage_totals[name][1] += seconds
+            self._append("spans.jsonl", record)
+
+    def timed(self, name: str | None = None):
+        """Decorator that records every call of the function as a span, named module.function by default."""
+        def decorator(function):
+            span_name = name or f"{function.__module__.rsplit('.', 1)[-1]}.{function.__name__}"
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_query(
+            self,
+            source: str,
+            company: str,
+            latency: float,
+            wait: float = 0.0,
+            pages: int = 1,
+            results: int = 0,
+            error: str | None = None,
+            retries: int = 0):
+        """
+        Records the search of one company.
+
+        Parameters:
+        source (str): Scraped website, e.g. "xing".
+        company (str): Searched company.
+        latency (float): Seconds from sending the query until all results were read.
+        wait (float): Seconds the query waited for the rate limiter before.
+        pages (int): Number of result pages visited.
+        results (int): Number of company names found.
+        error (str): Type of the exception if the query failed.
+        retries (int): Number of repeated requests, e.g. after throttling.
+        """
+        record = {"run": self.run_id, "time": time.time(), "source": source, "company": company,
+                  "latency": latency, "wait": wait, "pages": pages, "results": results,
+                  "error": error, "retries": retries}
+        with self._lock:
+            self.queries.append(record)
+            totals = self._query_totals[source]
+            totals["errors" if error else "ok"] += 1
+            for key in ["latency", "wait", "pages", "results", "retries"]:
+                totals[key] += record[key]
+        self._append("scraper.jsonl", record)
+
+    def breakdown(self, run_id: str | None = None) -> pd.DataFrame:
+        """Returns the number of calls and the time of every span name of a run (default: the current run)."""
+        run_id = run_id or self.run_id
+        with self._lock:
+            spans = [span for span in self.spans if span["run"] == run_id]
+        if not spans:
+            return pd.DataFrame(columns=["Stage", "Calls", "Seconds"])
+        df = pd.DataFrame(spans).groupby("name", sort=False)["seconds"].agg(["count", "sum"]).reset_index()
+        df.columns = ["Stage", "Calls", "Seconds"]
+        return df.sort_values("Seconds", ascending=False, kind="stable").reset_index(drop=True)
+
+    def query_summary(self, run_id: str | None = None) -> pd.DataFrame:
+        """Returns the number of queries, errors, the mean latency and wait and the totals per source of a run."""
+        run_id = run_id or self.run_id
+        with self._lock:
+            queries = [query for query in self.queries if query["run"] == run_id]
+        if not queries:
+            return pd.DataFrame()
+        df = pd.DataFrame(queries)
+        return df.groupby("source").agg(
+            Queries=("company", "size"),
+            Errors=("error", "count"),
+            **{"Mean latency (s)": ("latency", "mean"), "Mean wait (s)": ("wait", "mean")},
+            Pages=("pages", "sum"),
+            Results=("results", "sum"),
+            Retries=("retries", "sum"),
+        ).reset_index()
+
+    def prometheus_metrics(self) -> str:
+        """Returns the aggregated metrics since start in the Prometheus text format."""
+        lines = [
+            "# HELP findiq_stage_duration_seconds Time spent in instrumented stages.",
+            "# TYPE findiq_stage_duration_seconds summary",
+        ]
+        with self._lock:
+            stage_totals = dict(self._stage_totals)
+            query_totals = {source: dict(totals) for source, totals in self._query_totals.items()}
+        for name, (count, seconds) in stage_totals.items():
+            lines.append(f'findiq_stage_duration_seconds_sum{{stage="{_escape(name)}"}} {seconds:.6f}')
+            lines.append(f'findiq_stage_duration_seconds_count{{stage="{_escape(name)}"}} {count}')
+        metrics = [
+            ("findiq_scraper_queries_total", "counter", "Scraper queries by status.", None),
+            ("findiq_scraper_latency_seconds_total", "counter", "Total latency of scraper queries.", "latency"),
+            ("findiq_scraper_wait_seconds_total", "counter", "Total time scraper queries waited for the rate limiter.", "wait"),
+            ("findiq_scraper_pages_total", "counter", "Result pages visited by the scrapers.", "pages"),
+            ("findiq_scraper_results_total", "counter", "Company names found by the scrapers.", "results"),
+            ("findiq_scraper_retries_total", "counter", "Repeated scraper requests.", "retries"),
+        ]
+        for metric, metric_type, description, key in metrics:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {metric_type}"]
+            for source, totals in query_totals.items():
+                if key is None:
+                    for status in ["ok", "errors"]:
+                        lines.append(f'{metric}{{source="{_escape(source)}",status="{status}"}} {totals.get(status, 0):.0f}')
+                else:
+                    lines.append(f'{metric}{{source="{_escape(source)}"}} {totals.get(key, 0):g}')
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        """
+        Writes the Prometheus textfile. Spans and queries are already written when they are recorded.
+        Errors are only printed, as telemetry must not break the app or a scrape.
+        """
+        if self.directory is None:
+            return
+        metrics = self.prometheus_metrics()
+        path = os.path.join(self.directory, "metrics.prom")
+        tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with self._flush_lock:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(tmp_file, "w") as f:
+                    f.write(metrics)
+                os.replace(tmp_file, path)
+        except OSError as e:
+            print(f"Telemetry could not be written: {e}")
+
+
+telemetry = Telemetry()
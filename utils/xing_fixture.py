@@ -0,0 +1,98 @@
+"""
+Local fixture server for the HTTP mode of the Xing scraper.
+
+Serves the saved search result pages in FIXTURE_DIR instead of Xing and checks that http_scraper
+reads the expected company names from them:
+    python -m utils.xing_fixture
+
+A search is answered with the page <company>.html of the searched company, or with no_results.html
+if there is none. The company names expected for every search are listed in expected.json.
+When the markup of Xing changes, save the result pages again and update expected.json.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import urllib.parse
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.telemetry import telemetry
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "xing")
+SEARCH_PREFIX = "service technician "
+
+
+def fixture_handler(directory: str) -> type[BaseHTTPRequestHandler]:
+    """Returns a request handler that answers searches with the saved result pages in directory."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            company = query.get("keywords", [""])[0].removeprefix(SEARCH_PREFIX)
+            page = os.path.join(directory, f"{company}.html")
+            if not company or os.path.dirname(os.path.abspath(page)) != os.path.abspath(directory) \
+                    or not os.path.exists(page):
+                page = os.path.join(directory, "no_results.html")
+            with open(page, "rb") as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+@contextmanager
+def fixture_server(directory: str = FIXTURE_DIR) -> Iterator[str]:
+    """Serves the saved result pages on a free local port and yields the URL to pass as search_url."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), fixture_handler(directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def check(directory: str = FIXTURE_DIR) -> dict[str, tuple[list[str], list[str]]]:
+    """
+    Scrapes the companies of expected.json from the fixture server with http_scraper.
+
+    Returns:
+    dict: Expected and scraped company names of every company whose result differs.
+    """
+    from utils.xing_scraper import http_limiter, http_scraper
+    with open(os.path.join(directory, "expected.json")) as f:
+        expected = json.load(f)
+    results = {}
+    with fixture_server(directory) as url:
+        http_scraper(list(expected), search_url=url, max_workers=2, limiter=http_limiter(burst=len(expected)),
+                     on_result=lambda company, found: results.__setitem__(company, found))
+    return {c: (names, results.get(c)) for c, names in expected.items() if results.get(c) != names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the HTTP mode of the Xing scraper against saved result pages.")
+    parser.add_argument("--fixture-dir", default=FIXTURE_DIR)
+    args = parser.parse_args()
+
+    # Queries of the check are not written to the telemetry files of the app
+    telemetry.directory = None
+    mismatches = check(args.fixture_dir)
+    for company, (expected, found) in mismatches.items():
+        print(f"{company}: expected {expected}, found {found}")
+    if mismatches:
+        sys.exit(1)
+    print("All saved result pages were read correctly.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,78 @@
 import pandas as pd
 import os
+from collections.abc import Callable
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 import urllib.parse
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
-from time import sleep
+from selenium.common.exceptions import NoSuchElementException, NoSuchShadowRootException, StaleElementReferenceException
+from time import perf_counter
+from utils.batched_search import BATCH_SIZE, batched_search
+from utils.browser_session import BrowserSession
+from utils.rate_limit import AdaptiveRateLimiter
+from utils.telemetry import telemetry
 from dotenv import load_dotenv
 load_dotenv()
 
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+SEARCH_URL = "https://www.xing.com/jobs/search"
+COMPANY_SELECTOR = 'p[class*="job-teaser-list-item-styles__Company"]'
+RESULTS_PER_PAGE = 20  # Job teasers on the first page of the search results, the only page that is read
+# Message shown instead of job teasers when a search has no results. Not verified against the live site yet:
+# if it doesn't match, searches without results time out and are retried instead of being cached as empty.
+NO_RESULTS_SELECTOR = '[data-testid*="no-results"], [class*="NoResults"], [class*="no-results"]'
+
 def read_company_names(company_list, driver):
     company = driver.find_elements(
         By.CSS_SELECTOR,
-        'p[class*="job-teaser-list-item-styles__Company"]')
+        COMPANY_SELECTOR)
     for c in company:
         if c.text:
             company_list.append(c.text)
     return company_list
 
+class results_loaded:
+    """
+    Expected condition for WebDriverWait: the search was submitted and its results were rendered.
+
+    The condition holds once the URL has changed, the teasers shown before the search have been removed
+    from the page (staleness) and either new teasers or the no-results message are rendered. The teasers
+    may show the same companies as before. An empty page without the no-results message never counts
+    as loaded, so a slow page times out instead of being recorded as a company without ads.
+    """
+
+    def __init__(self, previous_url: str, previous_teaser):
+        self.previous_url = previous_url
+        self.previous_teaser = previous_teaser
+        self.names = None
+
+    def __call__(self, driver) -> bool:
+        if driver.current_url == self.previous_url:
+            return False
+        if self.previous_teaser is not None:
+            try:
+                self.previous_teaser.is_enabled()
+                return False
+            except StaleElementReferenceException:
+                self.previous_teaser = None
+        names = read_company_names([], driver)
+        if names or driver.find_elements(By.CSS_SELECTOR, NO_RESULTS_SELECTOR):
+            self.names = names
+            return True
+        return False
+
 def job_search(company_list, driver, company_name=""):
 
     # Enter search term into search field
@@ -27,11 +80,13 @@ def job_search(company_list, driver, company_name=""):
     search_input = WebDriverWait(driver, 10).until(
         EC.presence_of_element_located((By.ID, 'keywords-input'))
     )
+    previous_teasers = driver.find_elements(By.CSS_SELECTOR, COMPANY_SELECTOR)
+    condition = results_loaded(driver.current_url, previous_teasers[0] if previous_teasers else None)
     search_input.send_keys(search_term)
     search_input.send_keys(Keys.ENTER)
 
-    sleep(1.5)
-    company_list = read_company_names(company_list, driver)
+    WebDriverWait(driver, 10, poll_frequency=0.1).until(condition)
+    company_list.extend(condition.names)
     wait = WebDriverWait(driver, 8)
     clear_button = wait.until(
                 EC.element_to_be_clickable((By.XPATH, "//button[contains(@aria-label,'Clear')]"))
@@ -39,28 +94,222 @@ def job_search(company_list, driver, company_name=""):
     clear_button.click()
     return company_list
 
+def accept_cookies(driver):
+    """Accepts the usercentrics cookie banner if it is shown."""
+    try:
+        wait = WebDriverWait(driver, 5, poll_frequency=0.1,
+                             ignored_exceptions=(NoSuchElementException, NoSuchShadowRootException))
+        accept_button = wait.until(
+            lambda d: d.find_element(By.CSS_SELECTOR, "#usercentrics-root").shadow_root.find_element(By.CSS_SELECTOR, 'button[data-testid="uc-accept-all-button"]')
+        )
+        accept_button.click()
+    except Exception:
+        # Banner was already accepted with the restored cookies
+        pass
+
+def xing_session(cookie_file: str | None = "data/sessions/xing_cookies.json", **kwargs) -> BrowserSession:
+    """Creates a browser session on the Xing job search that can be shared by several calls of scraper()."""
+    return BrowserSession(SEARCH_URL, setup=accept_cookies, cookie_file=cookie_file, **kwargs)
+
 def scraper(
         companies: list[str],
-        email_address: str = os.environ['EMAIL'],
-        pw: str = os.environ['PASSWORD']
+        email_address: str | None = os.environ.get('EMAIL'),
+        pw: str | None = os.environ.get('PASSWORD'),
+        on_result: Callable[[str, list[str]], None] | None = None,
+        session: BrowserSession | None = None,
+        limiter: AdaptiveRateLimiter | None = None
 ) -> list[str]:
-
-    driver = webdriver.Chrome()
-    driver.maximize_window()
+    """
+    Searches for service technician ads of each company and returns the company names of all ads found.
+    If on_result is given, it is called after every successful search with the searched company
+    and the company names found for it.
+    If session is given, its driver is used and kept alive, otherwise a new browser is started and closed again.
+    The searches are paced by limiter, which backs off after errors.
+    """
+    own_session = session is None
+    if own_session:
+        session = xing_session(cookie_file=None, headless=False, block_resources=False)
+    if limiter is None:
+        limiter = AdaptiveRateLimiter()
     company_list = []
 
-    url = "https://www.xing.com/jobs/search"
-    driver.get(url)
-    sleep(2)
-    wait = WebDriverWait(driver, 8)
-    driver.find_element(By.CSS_SELECTOR, "#usercentrics-root").shadow_root.find_element(By.CSS_SELECTOR, 'button[data-testid="uc-accept-all-button"]').click()
     for c in companies:
+        waited = 0.0
+        start = perf_counter()
         try:
-            sleep(0.25)
-            # url = f"https://www.linkedin.com/jobs/"
-            company_list = job_search(company_list, driver, c)
-        except Exception:
+            waited = limiter.acquire(c)
+            start = perf_counter()
+            n_found = len(company_list)
+            company_list = job_search(company_list, session.driver, c)
+            limiter.success()
+            session.record_query()
+            telemetry.record_query("xing", c, perf_counter() - start, waited, results=len(company_list) - n_found)
+            if on_result is not None:
+                on_result(c, company_list[n_found:])
+        except Exception as e:
             print(f"Error with company {c}")
+            telemetry.record_query("xing", c, perf_counter() - start, waited, error=type(e).__name__)
+            limiter.failure()
+            session.recycle()
+
+    if own_session:
+        session.quit()
+    return company_list
+
+def batch_scraper(
+        companies: list[str],
+        email_address: str | None = os.environ.get('EMAIL'),
+        pw: str | None = os.environ.get('PASSWORD'),
+        on_result: Callable[[str, list[str]], None] | None = None,
+        session: BrowserSession | None = None,
+        limiter: AdaptiveRateLimiter | None = None,
+        batch_size: int = BATCH_SIZE
+) -> list[str]:
+    """
+    Same as scraper(), but searches for up to batch_size companies at once with an OR query and matches
+    the company names found to the searched companies (see batched_search).
+    """
+    own_session = session is None
+    if own_session:
+        session = xing_session(cookie_file=None, headless=False, block_resources=False)
+    if limiter is None:
+        limiter = AdaptiveRateLimiter()
+
+    def search(query: str) -> list[str] | None:
+        waited = 0.0
+        start = perf_counter()
+        try:
+            waited = limiter.acquire(query)
+            start = perf_counter()
+            found = job_search([], session.driver, query)
+        except Exception as e:
+            print(f"Error with query {query}")
+            telemetry.record_query("xing_batched", query, perf_counter() - start, waited, error=type(e).__name__)
+            limiter.failure()
+            session.recycle()
+            return None
+        limiter.success()
+        session.record_query()
+        telemetry.record_query("xing_batched", query, perf_counter() - start, waited, results=len(found))
+        return found
+
+    company_list = batched_search(companies, search, on_result, batch_size, page_size=RESULTS_PER_PAGE)
+    if own_session:
+        session.quit()
+    return company_list
+
+def parse_company_names(html: str) -> list[str]:
+    """Returns the company names of all job teasers on a Xing search results page."""
+    soup = BeautifulSoup(html, HTML_PARSER)
+    # Collapse whitespace like the text of a rendered element in Selenium
+    company_names = [" ".join(p.get_text(" ").split()) for p in soup.select(COMPANY_SELECTOR)]
+    return [c for c in company_names if c]
+
+def http_session(pool_size: int = 8) -> requests.Session:
+    """
+    Creates an HTTP session that keeps up to pool_size connections alive
+    and retries requests that failed because of throttling or server errors.
+    """
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+    return session
+
+def http_limiter(burst: int = 8) -> AdaptiveRateLimiter:
+    """Rate limiter for the HTTP scrapers, which can send many more queries than a browser."""
+    return AdaptiveRateLimiter(rate=5.0, max_rate=20.0, burst=burst)
+
+def _fetch(session: requests.Session, company_name: str, search_url: str, timeout: float) -> tuple[list[str], int]:
+    response = session.get(search_url, params={"keywords": f"service technician {company_name}"}, timeout=timeout)
+    response.raise_for_status()
+    retries = response.raw.retries
+    return parse_company_names(response.text), len(retries.history) if retries is not None else 0
+
+def fetch_job_search(session: requests.Session, company_name: str = "", search_url: str = SEARCH_URL, timeout: float = 10) -> list[str]:
+    """Requests the search results page for service technician ads of a company and returns the company names found."""
+    return _fetch(session, company_name, search_url, timeout)[0]
+
+def http_scraper(
+        companies: list[str],
+        search_url: str = SEARCH_URL,
+        max_workers: int = 8,
+        on_result: Callable[[str, list[str]], None] | None = None,
+        limiter: AdaptiveRateLimiter | None = None
+) -> list[str]:
+    """
+    Same as scraper(), but requests the search results pages directly instead of driving a browser.
+    At most max_workers requests are sent at the same time over a shared keep-alive session,
+    and all of them are paced by limiter.
+    search_url can point to a local server with saved result pages for testing.
+    """
+    session = http_session(pool_size=max_workers)
+    if limiter is None:
+        limiter = http_limiter(burst=max_workers)
+
+    def search(company_name: str) -> list[str] | None:
+        waited = limiter.acquire(company_name)
+        start = perf_counter()
+        try:
+            found, retries = _fetch(session, company_name, search_url, timeout=10)
+        except Exception as e:
+            print(f"Error with company {company_name}")
+            telemetry.record_query("xing", company_name, perf_counter() - start, waited, error=type(e).__name__)
+            limiter.failure()
+            return None
+        telemetry.record_query("xing", company_name, perf_counter() - start, waited,
+                               results=len(found), retries=retries)
+        # Requests are only retried after throttling or server errors, so the limiter backs off
+        if retries:
+            limiter.failure()
+        else:
+            limiter.success()
+        return found
+
+    company_list = []
+    with session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for c, found in zip(companies, pool.map(search, companies)):
+            if found is None:
+                continue
+            company_list.extend(found)
+            if on_result is not None:
+                on_result(c, found)
+    return company_list
+
+def http_batch_scraper(
+        companies: list[str],
+        search_url: str = SEARCH_URL,
+        max_workers: int = 8,
+        on_result: Callable[[str, list[str]], None] | None = None,
+        limiter: AdaptiveRateLimiter | None = None,
+        batch_size: int = BATCH_SIZE
+) -> list[str]:
+    """Same as http_scraper(), but searches for up to batch_size companies at once like batch_scraper()."""
+    session = http_session(pool_size=max_workers)
+    if limiter is None:
+        limiter = http_limiter(burst=max_workers)
+
+    def search(query: str) -> list[str] | None:
+        waited = limiter.acquire(query)
+        start = perf_counter()
+        try:
+            found, retries = _fetch(session, query, search_url, timeout=10)
+        except Exception as e:
+            print(f"Error with query {query}")
+            telemetry.record_query("xing_batched", query, perf_counter() - start, waited, error=type(e).__name__)
+            limiter.failure()
+            return None
+        telemetry.record_query("xing_batched", query, perf_counter() - start, waited,
+                               results=len(found), retries=retries)
+        # Requests are only retried after throttling or server errors, so the limiter backs off
+        if retries:
+            limiter.failure()
+        else:
+            limiter.success()
+        return found
 
-    driver.quit()
-    return company_list
\ No newline at end of file
+    with session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return batched_search(companies, search, on_result, batch_size, page_size=RESULTS_PER_PAGE,
+                              map_function=pool.map)